@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+# Simulate concurrent snakemake --wms-monitor clients. Each client starts a
+# run of a workflow (create_workflow) and posts a realistic mix of messages (job
+# info, progress, debug, errors and tracebacks) to update_workflow_status,
+# one request per message like snakemake. Reports messages per second,
+# p50/p99 request latency and the error rate, and exits with an error if
+# the error rate is over --max-error-rate.
+#
+# By default requests are made in process with the Django test client,
+# against a throwaway test database (e.g., for CI). This covers
+# UpdateWorkflow, token authentication and WorkflowStatus writes:
+#
+#   python benchmarks/monitor_load.py --clients 8 --messages 500
+#
+# The database is the one snakeface is configured with, SQLite by default.
+# For Postgres, start a local one and export the DATABASE_* variables:
+#
+#   docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=snakeface postgres:13
+#   export DATABASE_ENGINE=django.db.backends.postgresql DATABASE_HOST=localhost
+#   export DATABASE_USER=postgres DATABASE_PASSWORD=snakeface DATABASE_NAME=postgres
+#
+# To load a running server instead, give its url, an API token, and the ids
+# of workflows owned by the token's user (clients take them in turn):
+#
+#   python benchmarks/monitor_load.py --url http://127.0.0.1:5000 \
+#       --token <token> --workflow 1 2
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "snakeface.settings")
+
+RULES = ["all", "fastqc", "trim", "align", "sort", "index", "call", "report"]
+
+TRACEBACK = """Traceback (most recent call last):
+  File "/opt/snakemake/snakemake/executors/__init__.py", line 2314, in run_wrapper
+    run(input, output, params, wildcards, threads, resources, log, version, rule)
+  File "Snakefile", line 42, in __rule_%s
+ValueError: could not convert string to float: 'NA'"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Snakeface benchmark: concurrent monitor clients."
+    )
+    parser.add_argument(
+        "--clients",
+        dest="clients",
+        help="Number of concurrent monitor clients.",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "--messages",
+        dest="messages",
+        help="Number of status messages each client sends.",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--url",
+        dest="url",
+        help="Load a running snakeface server, instead of the test client.",
+    )
+    parser.add_argument(
+        "--token",
+        dest="token",
+        help="The API token for a running server (--url).",
+    )
+    parser.add_argument(
+        "--workflow",
+        dest="workflows",
+        help="Workflow ids to send statuses for on a running server (--url).",
+        type=int,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--max-error-rate",
+        dest="max_error_rate",
+        help="Exit with an error if more than this fraction of requests fail.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        help="Seed for the message mix.",
+        type=int,
+        default=0,
+    )
+    return parser
+
+
+def get_messages(count, seed):
+    """Generate the messages of a snakemake run: each job has a job_info,
+    a shell command and a job_finished (or, rarely, an error and traceback)
+    followed by progress, with some info and debug messages in between.
+    """
+    rng = random.Random(seed)
+    messages = [
+        {"level": "info", "msg": "Building DAG of jobs..."},
+        {"level": "info", "msg": "Using shell: /bin/bash"},
+    ]
+    jobid = 0
+    total = count // 4 + 1
+    while len(messages) < count:
+        jobid += 1
+        rule = rng.choice(RULES)
+        messages.append(
+            {
+                "level": "job_info",
+                "jobid": jobid,
+                "msg": None,
+                "name": rule,
+                "local": False,
+                "input": ["results/%s/%s.in" % (rule, jobid)],
+                "output": ["results/%s/%s.out" % (rule, jobid)],
+                "log": ["logs/%s/%s.log" % (rule, jobid)],
+                "benchmark": None,
+                "wildcards": {"sample": "sample%s" % jobid},
+                "reason": "Missing output files: results/%s/%s.out" % (rule, jobid),
+                "resources": {"_cores": 1, "_nodes": 1, "mem_mb": 1000},
+                "priority": 0,
+                "threads": 1,
+                "indent": False,
+                "is_checkpoint": False,
+                "printshellcmd": True,
+                "is_handover": False,
+            }
+        )
+        messages.append(
+            {"level": "shellcmd", "msg": "%s --threads 1 input > output" % rule}
+        )
+        if rng.random() < 0.2:
+            messages.append({"level": "debug", "msg": "Job %s is ready." % jobid})
+        if rng.random() < 0.02:
+            messages.append(
+                {
+                    "level": "error",
+                    "msg": "Error in rule %s:\n    jobid: %s" % (rule, jobid),
+                }
+            )
+            messages.append({"level": "error", "msg": TRACEBACK % rule})
+            continue
+        messages.append({"level": "job_finished", "jobid": jobid})
+        messages.append({"level": "progress", "done": jobid, "total": total})
+    return messages[:count]
+
+
+class Results(object):
+    """Latencies and counts from all clients"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+        self.throttled = 0
+        self.codes = {}
+
+    def add(self, latency, code):
+        with self.lock:
+            self.latencies.append(latency)
+            self.sent += 1
+            if code == 429:
+                self.throttled += 1
+            if code != 200:
+                self.errors += 1
+                self.codes[code] = self.codes.get(code, 0) + 1
+
+    def percentile(self, percent):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return latencies[index]
+
+
+class Client(object):
+    """A monitor client, for the test client or a running server"""
+
+    def __init__(self, token, url=None):
+        self.url = url
+        if url:
+            import requests
+
+            self.session = requests.Session()
+            self.session.headers["Authorization"] = "Bearer %s" % token
+        else:
+            from django.test import Client as TestClient
+
+            self.session = TestClient(HTTP_AUTHORIZATION="Bearer %s" % token)
+
+    def request(self, method, path, data=None):
+        if self.url:
+            response = getattr(self.session, method)(
+                "%s/%s" % (self.url.rstrip("/"), path), data=data
+            )
+            return response.status_code, response
+        response = getattr(self.session, method)("/%s" % path, data or {})
+        return response.status_code, response
+
+
+def run_client(number, token, wid, args, results):
+    """Start a run, and send the messages one request at a time"""
+    client = Client(token, args.url)
+    try:
+        code, _ = client.request("get", "create_workflow?id=%s" % wid)
+    except Exception as e:
+        print("Client %s failed to start a run: %s" % (number, e))
+        code = None
+    if code != 200:
+        print("Client %s could not start a run: %s" % (number, code))
+        for _ in range(args.messages):
+            results.add(0, code)
+        return
+
+    for message in get_messages(args.messages, args.seed + number):
+        data = {"msg": json.dumps(message), "timestamp": time.asctime(), "id": wid}
+        start = time.time()
+        try:
+            code, _ = client.request("post", "update_workflow_status", data)
+        except Exception as e:
+            print("Client %s failed to post: %s" % (number, e))
+            code = None
+        results.add(time.time() - start, code)
+
+    if not args.url:
+        from django.db import connection
+
+        connection.close()
+
+
+def run_clients(clients, args):
+    """Run a client for each (token, workflow id) at once"""
+    results = Results()
+    threads = [
+        threading.Thread(target=run_client, args=(i, token, wid, args, results))
+        for i, (token, wid) in enumerate(clients)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def run_in_process(args):
+    """Create a test database with a user, token and workflow per client,
+    and run the clients with the Django test client.
+    """
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    from rest_framework.authtoken.models import Token
+
+    setup_test_environment()
+    settings.ALLOWED_HOSTS = ["*"]
+    settings.RATELIMIT_ENABLE = False
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    from snakeface.apps.main.ingest import status_buffer
+    from snakeface.apps.main.models import Workflow, WorkflowStatus
+    from snakeface.apps.users.models import User
+
+    try:
+        clients = []
+        for i in range(args.clients):
+            user = User.objects.create(username="monitor%s" % i)
+            workflow = Workflow(command="snakemake", snakefile="Snakefile", workdir=".")
+            workflow.save()
+            workflow.owners.add(user)
+            clients.append((Token.objects.create(user=user).key, workflow.id))
+        results, seconds = run_clients(clients, args)
+
+        # Every accepted message must be written
+        if status_buffer.enabled:
+            status_buffer.stop()
+        added = WorkflowStatus.objects.count()
+        if added != results.sent - results.errors:
+            print("Accepted %s messages, but added %s." % (results.sent, added))
+            results.errors += abs(results.sent - results.errors - added)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results, seconds
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.url and not (args.token and args.workflows):
+        sys.exit("An API token (--token) and --workflow are needed with --url.")
+
+    if args.url:
+        clients = [
+            (args.token, args.workflows[i % len(args.workflows)])
+            for i in range(args.clients)
+        ]
+        results, seconds = run_clients(clients, args)
+    else:
+        results, seconds = run_in_process(args)
+
+    error_rate = results.errors / results.sent if results.sent else 0
+    print("target:              %s" % (args.url or "test client"))
+    print("clients:             %s" % args.clients)
+    print("messages:            %s" % results.sent)
+    print(
+        "throughput:          %.1f msgs/sec"
+        % ((results.sent - results.errors) / seconds)
+    )
+    print("latency p50:         %.1f ms" % (results.percentile(50) * 1000))
+    print("latency p99:         %.1f ms" % (results.percentile(99) * 1000))
+    print("errors:              %s (%.2f%%)" % (results.errors, error_rate * 100))
+    if results.codes:
+        print("error codes:         %s" % results.codes)
+    if results.throttled:
+        print("throttled (429):     %s" % results.throttled)
+    if error_rate > args.max_error_rate:
+        sys.exit(
+            "Error rate %.4f is over --max-error-rate %s"
+            % (error_rate, args.max_error_rate)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+# Measure the CPU that the web process spends per running workflow while
+# CommandRunner waits on an idle command. Run from the repository root:
+#
+#   python benchmarks/runner_cpu.py --workflows 4 --seconds 10
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from snakeface.apps.main.utils import CommandRunner  # noqa
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Snakeface benchmark: idle CPU per running workflow."
+    )
+    parser.add_argument(
+        "--workflows",
+        dest="workflows",
+        help="Number of concurrent runs to start.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--seconds",
+        dest="seconds",
+        help="How long each (idle) run should last.",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "--cancel-interval",
+        dest="cancel_interval",
+        help="How often the runner checks the cancel function.",
+        type=float,
+        default=1,
+    )
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    checks = {"count": 0}
+
+    def cancel_func():
+        checks["count"] += 1
+        return False
+
+    def run():
+        runner = CommandRunner()
+        runner.run_command(
+            ["sleep", str(args.seconds)],
+            cancel_func=cancel_func,
+            cancel_interval=args.cancel_interval,
+        )
+
+    threads = [threading.Thread(target=run) for _ in range(args.workflows)]
+    wall_start = time.time()
+    cpu_start = time.process_time()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    cpu = time.process_time() - cpu_start
+    wall = time.time() - wall_start
+
+    print("workflows:           %s" % args.workflows)
+    print("wall time (s):       %.2f" % wall)
+    print("process cpu (s):     %.4f" % cpu)
+    print("cancel checks:       %s" % checks["count"])
+    print("cpu per workflow:    %.3f%%" % (100 * cpu / wall / args.workflows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+# Compare status messages per second for the single message endpoint
+# (update_workflow_status) and the batch endpoint (update_workflow_statuses).
+# Requests are made in process with the Django test client, against a
+# throwaway test database. Run from the repository root:
+#
+#   python benchmarks/status_ingest.py --messages 2000 --batch-size 500
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "snakeface.settings")
+
+import django  # noqa
+
+django.setup()
+
+from django.conf import settings  # noqa
+from django.db import connection  # noqa
+from django.test import Client  # noqa
+from django.test.utils import setup_test_environment  # noqa
+from rest_framework.authtoken.models import Token  # noqa
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Snakeface benchmark: status messages per second."
+    )
+    parser.add_argument(
+        "--messages",
+        dest="messages",
+        help="Number of status messages to send with each endpoint.",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        help="Number of messages per request for the batch endpoint.",
+        type=int,
+        default=500,
+    )
+    return parser
+
+
+def get_message(i):
+    return {"level": "job_info", "jobid": i, "msg": "rule %s" % i, "rule": "all"}
+
+
+def main():
+    args = get_parser().parse_args()
+
+    setup_test_environment()
+    settings.ALLOWED_HOSTS = ["*"]
+    settings.RATELIMIT_ENABLE = False
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    from snakeface.apps.main.models import Workflow, WorkflowStatus
+    from snakeface.apps.users.models import User
+
+    try:
+        user = User.objects.create(username="benchmark")
+        token = Token.objects.create(user=user)
+        workflow = Workflow(command="snakemake", snakefile="Snakefile", workdir=".")
+        workflow.save()
+        workflow.owners.add(user)
+        workflow.new_run(user)
+
+        client = Client(HTTP_AUTHORIZATION="Bearer %s" % token.key)
+        results = {}
+
+        start = time.time()
+        for i in range(args.messages):
+            response = client.post(
+                "/update_workflow_status",
+                {"id": workflow.id, "msg": json.dumps(get_message(i))},
+            )
+            assert response.status_code == 200, response.status_code
+        results["single"] = time.time() - start
+
+        start = time.time()
+        for i in range(0, args.messages, args.batch_size):
+            messages = [
+                {"msg": get_message(j)}
+                for j in range(i, min(i + args.batch_size, args.messages))
+            ]
+            response = client.post(
+                "/update_workflow_statuses",
+                json.dumps({"id": workflow.id, "messages": messages}),
+                content_type="application/json",
+            )
+            assert response.status_code == 200, response.status_code
+        results["batch"] = time.time() - start
+
+        assert WorkflowStatus.objects.count() == 2 * args.messages
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print("messages:            %s" % args.messages)
+    print("batch size:          %s" % args.batch_size)
+    for name, seconds in results.items():
+        print("%-20s %.1f msgs/sec" % (name + ":", args.messages / seconds))
+    print("speedup:             %.1fx" % (results["single"] / results["batch"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+# Compare serializing workflow statuses when how they are shown (the level
+# badge, and a traceback formatted as code) is worked out for every row at
+# serialization, as snakeface used to, with the display fields that are now
+# stored when a status is created. Statuses are added to a throwaway test
+# database (a realistic mix, with some errors and tracebacks), and each is
+# timed over the rows already loaded and including the query. Run from the
+# repository root:
+#
+#   python benchmarks/status_serialize.py --statuses 100000
+
+import argparse
+import itertools
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "snakeface.settings")
+
+import django  # noqa
+
+django.setup()
+
+from django.db import connection  # noqa
+from django.test.utils import setup_test_environment  # noqa
+
+# Badge classes as serialization used them
+LEVELS = {
+    "debug": "primary",
+    "dag_debug": "primary",
+    "info": "info",
+    "warning": "warning",
+    "error": "danger",
+}
+
+TRACEBACK = """Traceback (most recent call last):
+  File "Snakefile", line 42, in __rule_align
+ValueError: could not convert string to float: 'NA'"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Snakeface benchmark: serializing workflow statuses."
+    )
+    parser.add_argument(
+        "--statuses",
+        dest="statuses",
+        help="Number of statuses in the run.",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="repeat",
+        help="Take the best of this many times.",
+        type=int,
+        default=3,
+    )
+    return parser
+
+
+def get_message(i):
+    if i % 50 == 0:
+        return {"level": "error", "msg": TRACEBACK}
+    if i % 10 == 0:
+        return {"level": "debug", "msg": "Job %s is ready." % i}
+    if i % 2:
+        return {"level": "job_info", "jobid": i, "msg": None, "name": "align"}
+    return {"level": "info", "msg": "Finished job %s." % i}
+
+
+def serialize_old(statuses):
+    """Serialization with the level badge and traceback regex for each row"""
+    data = []
+    for order, status in enumerate(statuses):
+        entry = status.message
+        msg = status.text or ""
+        level = LEVELS.get(status.level, "secondary")
+        badge = "<span class='badge badge-%s'>%s</span>" % (
+            level,
+            status.level or "info",
+        )
+        if msg and re.search("traceback|exception", msg, re.IGNORECASE):
+            msg = "<code>%s</code>" % msg.replace("\n", "<br>")
+        entry.update(
+            {
+                "id": status.id,
+                "order": order,
+                "job": status.job if status.job is not None else entry.get("job", ""),
+                "msg": msg,
+                "level": badge,
+            }
+        )
+        data.append(entry)
+    return data
+
+
+def best(func, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        seconds.append(time.time() - start)
+    return min(seconds)
+
+
+def main():
+    args = get_parser().parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+
+    from snakeface.apps.main.models import Workflow, WorkflowStatus
+    from snakeface.apps.main.tasks import serialize_status, serialize_workflow_statuses
+    from snakeface.apps.users.models import User
+
+    try:
+        user = User.objects.create(username="benchmark")
+        workflow = Workflow(command="snakemake", snakefile="Snakefile", workdir=".")
+        workflow.save()
+        workflow.owners.add(user)
+        run = workflow.new_run(user)
+
+        start = time.time()
+        WorkflowStatus.objects.bulk_create(
+            (
+                WorkflowStatus.from_message(get_message(i), workflow=workflow, run=run)
+                for i in range(args.statuses)
+            ),
+            batch_size=500,
+        )
+        created = time.time() - start
+        assert WorkflowStatus.objects.count() == args.statuses
+
+        statuses = list(run.get_statuses())
+        results = {
+            "regex (loaded)": best(lambda: serialize_old(statuses), args.repeat),
+            "stored (loaded)": best(
+                lambda: [serialize_status(s, i) for i, s in enumerate(statuses)],
+                args.repeat,
+            ),
+            "regex (query)": best(
+                lambda: serialize_old(workflow.iter_statuses()), args.repeat
+            ),
+            "stored (query)": best(
+                lambda: serialize_workflow_statuses(workflow), args.repeat
+            ),
+        }
+
+        # The same statuses and messages either way
+        for old, new in itertools.zip_longest(
+            serialize_old(statuses), serialize_workflow_statuses(workflow)
+        ):
+            assert old["msg"] == new["msg"] and old["id"] == new["id"]
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print("statuses:            %s" % args.statuses)
+    print("created:             %.1f statuses/sec" % (args.statuses / created))
+    for name, seconds in results.items():
+        print("%-20s %.1f ms" % (name + ":", seconds * 1000))
+    for kind in ["loaded", "query"]:
+        print(
+            "speedup (%s):%s%.1fx"
+            % (
+                kind,
+                " " * (10 - len(kind)),
+                results["regex (%s)" % kind] / results["stored (%s)" % kind],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -75,6 +75,7 @@ if __name__ == "__main__":
     TESTS_REQUIRES = get_reqs(lookup, "TESTS_REQUIRES")
     ALL_REQUIRES = get_reqs(lookup, "ALL_REQUIRES")
     INSTALL_EMAIL_REQUIRES = get_reqs(lookup, "EMAIL_REQUIRES")
+    INSTALL_REDIS_REQUIRES = get_reqs(lookup, "REDIS_REQUIRES")
 
     setup(
         name=NAME,
@@ -98,6 +99,7 @@ if __name__ == "__main__":
         extras_require={
             "all": ALL_REQUIRES,
             "email": INSTALL_EMAIL_REQUIRES,
+            "redis": INSTALL_REDIS_REQUIRES,
         },
         classifiers=[
             "Intended Audience :: Science/Research",
@@ -0,0 +1,363 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from snakeface.apps.api.recorder import (
+    get_workflow_id,
+    merge_streams,
+    read_recording,
+    rewrite_lines,
+    rewrite_workflow_ids,
+)
+
+from urllib.parse import urlparse
+import base64
+import collections
+import json
+import os
+import requests
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+
+
+class ViewerSocket(object):
+    """A minimal websocket client for viewers, which only receive frames
+    (and answer pings). The autobahn client can't be used here, since
+    daphne already set up txaio for twisted in this process.
+    """
+
+    def __init__(self, url, path, cookie=None, timeout=10):
+        secure = url.scheme == "https"
+        port = url.port or (443 if secure else 80)
+        self.sock = socket.create_connection((url.hostname, port), timeout=timeout)
+        if secure:
+            context = ssl.create_default_context()
+            self.sock = context.wrap_socket(self.sock, server_hostname=url.hostname)
+        self.buffer = b""
+
+        key = base64.b64encode(os.urandom(16)).decode("utf-8")
+        headers = [
+            "GET %s HTTP/1.1" % path,
+            "Host: %s" % url.netloc,
+            "Origin: %s://%s" % (url.scheme, url.netloc),
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Key: %s" % key,
+            "Sec-WebSocket-Version: 13",
+        ]
+        if cookie:
+            headers.append("Cookie: %s" % cookie)
+        self.sock.sendall(("\r\n".join(headers) + "\r\n\r\n").encode("utf-8"))
+        while b"\r\n\r\n" not in self.buffer:
+            self.fill()
+        response, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+        if b" 101 " not in response.split(b"\r\n")[0]:
+            raise OSError(response.split(b"\r\n")[0].decode("utf-8"))
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError("The websocket closed.")
+        self.buffer += data
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            self.fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, opcode, payload):
+        """Send a (masked, as a client must) frame"""
+        mask = os.urandom(4)
+        header = bytes([0x80 | opcode, 0x80 | len(payload)]) + mask
+        masked = bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
+        self.sock.sendall(header + masked)
+
+    def recv(self, timeout):
+        """Return the next message (json), False if there is none within the
+        timeout, or None if the socket closed
+        """
+        pending = getattr(self.sock, "pending", lambda: 0)()
+        if not self.buffer and not pending:
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return False
+        message = b""
+        try:
+            while True:
+                first, second = self.read(2)
+                length = second & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.read(8))[0]
+                payload = self.read(length)
+                opcode = first & 0x0F
+                if opcode == 8:
+                    return None
+                if opcode == 9:
+                    self.send(10, payload[:125])
+                    continue
+                message += payload
+                if first & 0x80:
+                    return json.loads(message.decode("utf-8"))
+        except (EOFError, OSError):
+            return None
+
+    def close(self):
+        try:
+            self.send(8, b"")
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class Command(BaseCommand):
+    """Replay monitor requests recorded with MONITOR_RECORD_DIRECTORY against
+    a snakeface server, with the recorded timing (or faster). The requests of
+    each recorded workflow are sent in order, and workflows at the same time.
+    A streamed request is sent with its chunks at the recorded times.
+    Viewers do what the workflow details page does: load the page and the
+    first page of the status table, then get update frames over the
+    websocket, and load the table page again when there are new statuses.
+
+        python manage.py replay_monitor monitor-*.jsonl.gz --token <token> \\
+            --workflow 1 --speed 10 --viewers 2 --session <sessionid>
+    """
+
+    help = "Replay recorded monitor requests against a snakeface server."
+
+    def add_arguments(self, parser):
+        parser.add_argument("recordings", nargs="+", help="Recording files.")
+        parser.add_argument(
+            "--url", default="http://127.0.0.1:5000", help="The snakeface server."
+        )
+        parser.add_argument("--token", help="An API token for the server.")
+        parser.add_argument(
+            "--speed",
+            type=float,
+            default=1,
+            help="Replay speed (e.g., 1 or 10 times), 0 is as fast as possible.",
+        )
+        parser.add_argument(
+            "--from-workflow", help="Only replay requests for this recorded id."
+        )
+        parser.add_argument(
+            "--workflow",
+            type=int,
+            help="Send all requests for this workflow id on the server.",
+        )
+        parser.add_argument(
+            "--viewers",
+            type=int,
+            default=0,
+            help="Number of clients viewing the workflow details page.",
+        )
+        parser.add_argument(
+            "--session", help="A session id (cookie) for viewers to log in with."
+        )
+        parser.add_argument(
+            "--page-length",
+            type=int,
+            default=200,
+            help="The number of statuses in a page of the status table.",
+        )
+
+    def handle(self, *args, **options):
+        self.url = options["url"].rstrip("/")
+        self.token = options["token"]
+        self.lock = threading.Lock()
+        self.codes = collections.Counter()
+        self.latencies = []
+        self.lag = 0
+        self.frames = 0
+        self.pages = 0
+
+        entries = []
+        for filename in options["recordings"]:
+            entries += list(read_recording(filename))
+        if options["from_workflow"]:
+            entries = [
+                x for x in entries if get_workflow_id(x) == options["from_workflow"]
+            ]
+        if not entries:
+            raise CommandError("There are no requests to replay.")
+        entries.sort(key=lambda x: x["time"])
+        entries = merge_streams(entries)
+
+        # Requests for each recorded workflow are sent in order
+        groups = collections.OrderedDict()
+        for entry in entries:
+            groups.setdefault(get_workflow_id(entry), []).append(entry)
+        target = options["workflow"]
+        rewrite = (lambda wid: target) if target else (lambda wid: wid)
+        viewed = target or next((x for x in groups if x), None)
+
+        start = time.time()
+        first = entries[0]["time"]
+        speed = options["speed"]
+        done = threading.Event()
+        threads = [
+            threading.Thread(
+                target=self.replay, args=(group, start, first, speed, rewrite)
+            )
+            for group in groups.values()
+        ]
+        viewers = []
+        if viewed:
+            viewers = [
+                threading.Thread(
+                    target=self.view,
+                    args=(viewed, options["session"], options["page_length"], done),
+                )
+                for _ in range(options["viewers"])
+            ]
+        for thread in threads + viewers:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        for thread in viewers:
+            thread.join()
+        seconds = time.time() - start
+
+        latencies = sorted(self.latencies) or [0]
+        recorded = entries[-1]["time"] - first
+        self.stdout.write("requests:            %s" % len(entries))
+        self.stdout.write("recorded seconds:    %.1f" % recorded)
+        self.stdout.write("replay seconds:      %.1f" % seconds)
+        self.stdout.write("requests/sec:        %.1f" % (len(entries) / seconds))
+        for percent in [50, 99]:
+            latency = latencies[
+                min(len(latencies) - 1, len(latencies) * percent // 100)
+            ]
+            self.stdout.write(
+                "latency p%s:         %.1f ms" % (percent, latency * 1000)
+            )
+        self.stdout.write("max lag:             %.1f s" % self.lag)
+        if viewers:
+            self.stdout.write("viewer frames:       %s" % self.frames)
+            self.stdout.write("viewer table pages:  %s" % self.pages)
+        self.stdout.write("status codes:        %s" % dict(self.codes))
+
+    def wait(self, recorded, start, first, speed):
+        """Wait until the time a request (or chunk) was recorded at"""
+        if not speed:
+            return
+        due = start + (recorded - first) / speed
+        wait = due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        else:
+            with self.lock:
+                self.lag = max(self.lag, -wait)
+
+    def replay(self, entries, start, first, speed, rewrite):
+        """Send the requests for one workflow, at the recorded times"""
+        session = requests.Session()
+        if self.token:
+            session.headers["Authorization"] = "Bearer %s" % self.token
+        for entry in entries:
+            self.wait(entry["time"], start, first, speed)
+            query, body = rewrite_workflow_ids(entry, rewrite)
+            body = body.encode("utf-8")
+
+            # A streamed body is sent (chunked) as it was received
+            if "chunks" in entry:
+
+                def chunks(entry=entry):
+                    for recorded, chunk in entry["chunks"]:
+                        self.wait(recorded, start, first, speed)
+                        yield chunk
+
+                body = (x.encode("utf-8") for x in rewrite_lines(chunks(), rewrite))
+
+            url = self.url + entry["path"] + ("?%s" % query if query else "")
+            headers = {"Content-Type": entry["type"]} if entry["type"] else {}
+            sent = time.time()
+            try:
+                response = session.request(
+                    entry["method"], url, data=body, headers=headers
+                )
+                code = response.status_code
+            except requests.RequestException as e:
+                print("Failed to replay %s: %s" % (entry["path"], e))
+                code = None
+            with self.lock:
+                self.latencies.append(time.time() - sent)
+                self.codes[code] += 1
+
+    def view(self, wid, session_id, page_length, done):
+        """Load the details page and the first page of the status table, and
+        then get update frames of the workflow (protocol v2) over the
+        websocket until done, reconnecting with the last frame. New
+        statuses in a frame are added to the table (their ids are kept), and
+        the table page is loaded again for a new run, or if statuses are
+        missing before them.
+        """
+        session = requests.Session()
+        if session_id:
+            session.cookies.set("sessionid", session_id)
+        session.get(self.url + reverse("main:view_workflow", args=[wid]))
+        viewer = {"stream": None, "seq": None, "last_id": None, "run": None}
+        self.get_table(session, wid, page_length, viewer)
+
+        url = urlparse(self.url)
+        cookie = "sessionid=%s" % session_id if session_id else None
+        while not done.is_set():
+            path = "/ws/workflows/%s/?v=2" % wid
+            if viewer["stream"]:
+                path += "&stream=%s&seq=%s" % (viewer["stream"], viewer["seq"])
+            try:
+                ws = ViewerSocket(url, path, cookie)
+            except (EOFError, OSError) as e:
+                print("Failed to connect a viewer: %s" % e)
+                done.wait(2)
+                continue
+
+            while not done.is_set():
+                frame = ws.recv(timeout=0.5)
+                if frame is False:
+                    continue
+                if frame is None:
+                    break
+                if frame.get("missing"):
+                    print("Viewer stopped: %s" % frame["missing"])
+                    ws.close()
+                    return
+                with self.lock:
+                    self.frames += 1
+                viewer.update({"stream": frame["stream"], "seq": frame["seq"]})
+                changed = (frame["last_id"], frame["run"]) != (
+                    viewer["last_id"],
+                    viewer["run"],
+                )
+                added = frame.get("statuses") and not frame["reset"]
+                if added and frame["since"] <= (viewer["last_id"] or 0):
+                    viewer["last_id"] = max(viewer["last_id"], frame["last_id"])
+                elif changed and (frame["changed"] or frame["reset"]):
+                    self.get_table(session, wid, page_length, viewer)
+            ws.close()
+
+    def get_table(self, session, wid, page_length, viewer):
+        """Load the first page of the status table, like the details page"""
+        url = self.url + reverse("main:workflow_statuses_table", args=[wid])
+        params = {
+            "draw": self.pages + 1,
+            "start": 0,
+            "length": page_length,
+            "order[0][column]": 1,
+            "order[0][dir]": "asc",
+        }
+        try:
+            data = session.get(url, params=params).json()
+            viewer.update({"last_id": data.get("last_id"), "run": data.get("run")})
+        except (requests.RequestException, ValueError) as e:
+            print("Failed to get the status table: %s" % e)
+        with self.lock:
+            self.pages += 1
@@ -1,5 +1,15 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 from rest_framework.authtoken.models import Token
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from snakeface.cache import MISSING, TTLCache
+from snakeface.settings import cfg
+
+# Users for bearer tokens, invalidated when a token (or user) changes
+token_cache = TTLCache(size=cfg.TOKEN_CACHE_SIZE, ttl=cfg.TOKEN_CACHE_SECONDS)
+
+# Bearer tokens that don't exist, kept apart so they can't push out users
+unknown_tokens = TTLCache(size=cfg.TOKEN_CACHE_SIZE, ttl=cfg.TOKEN_CACHE_SECONDS)
 
 
 class AllowAnyGet(BasePermission):
@@ -18,21 +28,40 @@ class AllowAnyGet(BasePermission):
 
 def check_user_authentication(request):
     """Given a request, check that the user is authenticated via a token in
-    the header.
+    the header. The user for a bearer token is cached, so the common case
+    (a monitor sending statuses) doesn't query for the token.
     """
-    token = get_token(request)
+    header = request.META.get("HTTP_AUTHORIZATION")
+    if header:
+        user = get_token_user(header.split(" ")[-1].strip())
+    else:
+        token = get_token(request)
+        user = token.user if token else None
 
-    # Case 1: no token and auth is required, prompt the user for it
-    if not token:
+    # No token (or not a known token) and auth is required, prompt for it
+    if not user:
         return None, 401
+    return user, 200
 
-    # Case 2: the token is not associated with a user
-    try:
-        token = Token.objects.get(key=token)
-    except:
-        return None, 403
 
-    return token.user, 200
+def get_token_user(key):
+    """Return the user for a token key, or None if the token doesn't exist.
+    Found users are cached (see token_cache), and so are unknown tokens (see
+    unknown_tokens), so a client sending a made up token doesn't query for
+    it on every request.
+    """
+    user = token_cache.get(key)
+    if user is not MISSING:
+        return user
+    if unknown_tokens.get(key) is not MISSING:
+        return None
+    try:
+        user = Token.objects.select_related("user").get(key=key).user
+    except Token.DoesNotExist:
+        unknown_tokens.set(key, True)
+        return None
+    token_cache.set(key, user)
+    return user
 
 
 def get_token(request):
@@ -55,3 +84,18 @@ def get_token(request):
             return Token.objects.get(user=request.user)
         except Token.DoesNotExist:
             pass
+
+
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+    unknown_tokens.delete(instance.key)
+
+
+def invalidate_token_user(sender, instance, **kwargs):
+    token_cache.delete_matching(lambda key, user: user.pk == instance.pk)
+
+
+post_save.connect(invalidate_token, sender=Token)
+post_delete.connect(invalidate_token, sender=Token)
+post_save.connect(invalidate_token_user, sender=settings.AUTH_USER_MODEL)
+post_delete.connect(invalidate_token_user, sender=settings.AUTH_USER_MODEL)
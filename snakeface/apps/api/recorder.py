@@ -0,0 +1,229 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+
+from urllib.parse import parse_qsl, urlencode
+import atexit
+import codecs
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+
+# The paths of monitor requests that are recorded (and replayed)
+MONITOR_PATHS = [
+    "/create_workflow",
+    "/update_workflow_status",
+    "/update_workflow_statuses",
+]
+
+# A streamed request (see StreamIngestConsumer) is recorded a chunk at a time
+STREAM_PATH = "/stream_workflow_statuses"
+
+
+class MonitorRecording(object):
+    """The file monitor requests are recorded to, one json object per line,
+    gzipped, in MONITOR_RECORD_DIRECTORY. It is opened with the first
+    request, and flushed after each entry, so it can be read (e.g., by the
+    replay_monitor command) while snakeface is still running.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def __str__(self):
+        return "[monitor-recording:%s]" % (self.fd.name if self.fd else None)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def write(self, entry):
+        with self.lock:
+            if not self.fd:
+                os.makedirs(cfg.MONITOR_RECORD_DIRECTORY, exist_ok=True)
+                filename = os.path.join(
+                    cfg.MONITOR_RECORD_DIRECTORY,
+                    "monitor-%s-%s.jsonl.gz"
+                    % (time.strftime("%Y%m%d-%H%M%S"), os.getpid()),
+                )
+                self.fd = gzip.open(filename, "wt")
+                atexit.register(self.close)
+                print("Recording monitor requests to %s" % filename)
+            if not self.fd.closed:
+                self.fd.write(json.dumps(entry) + "\n")
+                self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fd:
+                self.fd.close()
+
+
+class MonitorRecorder(object):
+    """Middleware that records monitor requests with the time, method, path,
+    query, content type, body and response status (see MonitorRecording).
+    These are form or json requests, that the view reads whole anyway.
+    Streamed requests aren't Django requests, StreamRecorder records them
+    as they arrive. Tokens are not recorded, replay uses its own.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path not in MONITOR_PATHS:
+            return self.get_response(request)
+
+        # Reading the body first keeps it for the view
+        entry = {
+            "time": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "query": request.META.get("QUERY_STRING", ""),
+            "type": request.META.get("CONTENT_TYPE", ""),
+            "body": request.body.decode("utf-8", errors="replace"),
+        }
+        response = self.get_response(request)
+        entry["status"] = response.status_code
+        monitor_recording.write(entry)
+        return response
+
+
+class StreamRecorder(object):
+    """Record a streamed request (from its ASGI scope) one chunk of the body
+    at a time, as it arrives, so the body is never held. Each chunk is an
+    entry with the request, the id of the stream and more_body, and the
+    last one has the response status. replay_monitor puts them together.
+    """
+
+    def __init__(self, scope):
+        headers = dict(scope.get("headers", []))
+        self.request = {
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope["query_string"].decode("utf-8"),
+            "type": headers.get(b"content-type", b"").decode("utf-8"),
+            "stream": uuid.uuid4().hex[:16],
+        }
+
+        # A character can be split across chunks
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def write(self, received, chunk, more_body, status=None):
+        """Record a chunk of the body, received at a time"""
+        entry = {"time": received}
+        entry.update(self.request)
+        entry["body"] = self.decoder.decode(chunk, final=not more_body)
+        entry["more_body"] = more_body
+        if status is not None:
+            entry["status"] = status
+        monitor_recording.write(entry)
+
+
+def read_recording(filename):
+    """Yield the entries of a recording. A recording that is still being
+    written (or from a process that was killed) ends with a partial gzip
+    member, the entries before it are returned.
+    """
+    with gzip.open(filename, "rt") as fd:
+        try:
+            for line in fd:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except EOFError:
+            return
+
+
+def merge_streams(entries):
+    """Put the recorded chunks of each streamed request together, as one
+    request at the time of its first chunk, with the (time, body) of each
+    chunk in chunks, and the response status from the last one
+    """
+    merged = []
+    streams = {}
+    for entry in entries:
+        if "stream" not in entry:
+            merged.append(entry)
+            continue
+        request = streams.get(entry["stream"])
+        if request is None:
+            request = dict(entry, chunks=[])
+            streams[entry["stream"]] = request
+            merged.append(request)
+        request["chunks"].append((entry["time"], entry["body"]))
+        if "status" in entry:
+            request["status"] = entry["status"]
+    return merged
+
+
+def get_workflow_id(entry):
+    """The (first) workflow id of a recorded request, or None"""
+    ids = []
+    rewrite_workflow_ids(entry, lambda wid: ids.append(str(wid)) or wid)
+    return ids[0] if ids else None
+
+
+def rewrite_line(line, func):
+    """Apply func to the workflow id of a line of an ndjson (stream) body"""
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return line
+    if isinstance(message, dict) and "id" in message:
+        message["id"] = func(message["id"])
+    return json.dumps(message)
+
+
+def rewrite_lines(chunks, func):
+    """Yield the chunks of a streamed body, with func applied to the workflow
+    id of each line, as the lines are complete (a line can be split across
+    chunks)
+    """
+    partial = ""
+    for chunk in chunks:
+        lines = (partial + chunk).split("\n")
+        partial = lines.pop()
+        if lines:
+            yield "".join(rewrite_line(line, func) + "\n" for line in lines)
+    if partial:
+        yield rewrite_line(partial, func)
+
+
+def rewrite_workflow_ids(entry, func):
+    """Return the query and body of a recorded request, with func applied to
+    each workflow id, in the query, a form body, a json (batch) body or the
+    lines of an ndjson (stream) body.
+    """
+    query = parse_qsl(entry["query"], keep_blank_values=True)
+    query = urlencode([(k, func(v) if k == "id" else v) for k, v in query])
+    body = entry["body"]
+
+    def rewrite_message(message):
+        if isinstance(message, dict) and "id" in message:
+            message["id"] = func(message["id"])
+        return message
+
+    if entry["type"].startswith("application/x-www-form-urlencoded"):
+        body = parse_qsl(body, keep_blank_values=True)
+        body = urlencode([(k, func(v) if k == "id" else v) for k, v in body])
+
+    elif entry["path"] == STREAM_PATH:
+        body = "\n".join(rewrite_line(line, func) for line in body.split("\n"))
+
+    elif entry["type"].startswith("application/json"):
+        try:
+            data = rewrite_message(json.loads(body))
+            if isinstance(data, dict) and isinstance(data.get("messages"), list):
+                data["messages"] = [rewrite_message(x) for x in data["messages"]]
+            body = json.dumps(data)
+        except ValueError:
+            pass
+    return query, body
+
+
+monitor_recording = MonitorRecording()
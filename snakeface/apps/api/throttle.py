@@ -0,0 +1,190 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+from rest_framework.response import Response
+
+import collections
+import hashlib
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+    """A token bucket: it holds up to burst tokens, and refills at rate tokens
+    per second. Each message takes a token, so a client can send a burst of
+    messages at once, and then rate messages per second sustained.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, count):
+        """Seconds until count tokens are available (0 if they are now)"""
+        if count <= self.tokens:
+            return 0
+        return (min(count, self.burst) - self.tokens) / self.rate
+
+
+class MonitorThrottle(object):
+    """Rate limits for monitor ingestion, with an in-memory token bucket for
+    each API token (or ip address without one) and each workflow. Buckets
+    are kept for at most MONITOR_RATE_KEYS keys (least recently used are
+    dropped, which refills them), so memory is bounded and a check is a
+    dictionary lookup and some arithmetic. Buckets are only added for
+    requests that were authenticated (and allowed to update the workflows),
+    so requests with made up tokens or workflow ids can't push out others.
+    Before that, requests are limited per ip address (see check_address).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+        self.throttled = 0
+
+    def __str__(self):
+        return "[monitor-throttle:%s buckets]" % len(self.buckets)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_bucket(self, key, rate, burst):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            self.buckets[key] = bucket
+            while len(self.buckets) > cfg.MONITOR_RATE_KEYS:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(key)
+        return bucket
+
+    def get_limits(self, client, counts, workflows=True):
+        """The (key, count, rate, burst) limits for a request from a client
+        with counts of messages per workflow id. Without a client, only the
+        workflow limits (and without workflows, only the client limit).
+        """
+        limits = []
+        if client and cfg.MONITOR_TOKEN_RATE:
+            limits.append(
+                (
+                    ("client", client),
+                    sum(counts.values()),
+                    cfg.MONITOR_TOKEN_RATE,
+                    cfg.MONITOR_TOKEN_BURST,
+                )
+            )
+        if workflows and cfg.MONITOR_WORKFLOW_RATE:
+            for wid, count in counts.items():
+                limits.append(
+                    (
+                        ("workflow", wid),
+                        count,
+                        cfg.MONITOR_WORKFLOW_RATE,
+                        cfg.MONITOR_WORKFLOW_BURST,
+                    )
+                )
+        return limits
+
+    def take(self, limits, add=True):
+        """Take tokens for limits, only if every bucket has enough, otherwise
+        return the seconds to wait. If add is False, limits without a bucket
+        are skipped, and None is returned if none had one.
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            wait = 0
+            for key, count, rate, burst in limits:
+                if not add and key not in self.buckets:
+                    continue
+                bucket = self.get_bucket(key, rate, burst)
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(count))
+                buckets.append((bucket, count))
+            if not add and not buckets:
+                return None
+            if wait:
+                self.throttled += 1
+                return wait
+            for bucket, count in buckets:
+                bucket.tokens -= min(count, bucket.burst)
+        return 0
+
+    def check(self, client, counts, charged=False):
+        """Take tokens for an authenticated request from a client (see
+        get_client_key) with counts of messages per workflow id, from the
+        client bucket (unless it was charged by check_client) and the
+        workflow buckets. Returns the seconds to wait, or 0.
+        """
+        return self.take(self.get_limits(None if charged else client, counts))
+
+    def check_address(self, address):
+        """Take a token for a request (or connection) from an ip address,
+        before it is authenticated, so requests without a token or with a
+        made up one are limited too. Returns the seconds to wait, or 0.
+        """
+        if not address or not cfg.MONITOR_ADDRESS_RATE:
+            return 0
+        rate, burst = cfg.MONITOR_ADDRESS_RATE, cfg.MONITOR_ADDRESS_BURST
+        return self.take([(("address", address), 1, rate, burst)])
+
+    def check_client(self, client, counts):
+        """Take tokens for a request before it is authenticated, only from
+        the client bucket, and only if the client already has one (a bucket
+        is added by check). Returns the seconds to wait, 0, or None if the
+        client has no bucket (and wasn't charged).
+        """
+        limits = self.get_limits(client, counts, workflows=False)
+        return self.take(limits, add=False)
+
+
+def get_client_key(token, address):
+    """The key for a client: a hash of the API token (so tokens aren't kept
+    in memory), or the ip address without one
+    """
+    if token:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    return address
+
+
+def get_client(request):
+    """The key for the client of a request: the bearer token, or the ip"""
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    token = header.split(" ")[-1].strip()
+    return get_client_key(token, request.META.get("REMOTE_ADDR"))
+
+
+def throttle_monitor(request, counts, authenticated=True):
+    """Check monitor rate limits for a request, given the counts of messages
+    per workflow id. Before the request is authenticated (and the workflows
+    are checked) only the ip address and the client are limited, see
+    check_address and check_client, and once it is the workflows are limited
+    too. Returns a 429 response if over the limit, else None.
+    """
+    client = get_client(request)
+    if not authenticated:
+        wait = monitor_throttle.check_address(request.META.get("REMOTE_ADDR"))
+        if not wait:
+            wait = monitor_throttle.check_client(client, counts)
+            request.monitor_charged = wait is not None
+    else:
+        charged = getattr(request, "monitor_charged", False)
+        wait = monitor_throttle.check(client, counts, charged=charged)
+    if wait:
+        return Response(
+            status=429,
+            data={"message": "Too many status updates, try again later."},
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+
+monitor_throttle = MonitorThrottle()
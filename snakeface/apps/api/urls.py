@@ -11,6 +11,16 @@ urlpatterns = [
         api_views.ServiceInfo.as_view(),
         name="service_info",
     ),
+    path(
+        "api/queue",
+        api_views.WorkflowQueue.as_view(),
+        name="workflow_queue",
+    ),
+    path(
+        "api/ingest",
+        api_views.IngestStats.as_view(),
+        name="ingest_stats",
+    ),
     path(
         "create_workflow",
         api_views.CreateWorkflow.as_view(),
@@ -21,6 +31,11 @@ urlpatterns = [
         api_views.UpdateWorkflow.as_view(),
         name="update_workflow_status",
     ),
+    path(
+        "update_workflow_statuses",
+        api_views.UpdateWorkflowBatch.as_view(),
+        name="update_workflow_statuses",
+    ),
 ]
 
 
@@ -5,15 +5,46 @@ from ratelimit.mixins import RatelimitMixin
 from django.shortcuts import get_object_or_404
 
 from snakeface.apps.main.models import Workflow, WorkflowStatus
+from snakeface.apps.main.scheduler import run_queue
+from snakeface.apps.main.events import workflow_events
+from snakeface.apps.main.ingest import status_buffer
+from snakeface.apps.main.membership import is_owner
 from snakeface.settings import cfg
 from snakeface.version import __version__
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .permissions import check_user_authentication
+from .throttle import throttle_monitor
 
+import collections
 import json
 
 
+def parse_status(message, default_id=None):
+    """Parse a status message for a batch or stream, a dict with the workflow
+    id and the message (a json object, or a json string). Returns the
+    workflow id and message, and raises a ValueError (or TypeError or
+    AttributeError) if it isn't valid.
+    """
+    msg = message.get("msg", {})
+    if isinstance(msg, str):
+        msg = json.loads(msg)
+    return int(message.get("id", default_id)), msg
+
+
+def add_buffered(statuses, data=None):
+    """Add statuses to the write-behind buffer. If it is full, the client
+    should retry after the buffer has been flushed.
+    """
+    if not status_buffer.put(statuses):
+        return Response(
+            status=503,
+            data={"message": "Too many status updates, try again later."},
+            headers={"Retry-After": str(status_buffer.retry_after())},
+        )
+    return Response(status=200, data=data or {})
+
+
 class ServiceInfo(RatelimitMixin, APIView):
     """Return a 200 response to indicate a running service. Note that we are
     not currently including all required fields. See:
@@ -78,16 +109,11 @@ class CreateWorkflow(RatelimitMixin, APIView):
                 return Response(status=response_code)
 
             # If we have a workflow, check that user has permission to use/update
-            if workflow and user not in workflow.owners.all():
+            if workflow and not is_owner(workflow, user):
                 return Response(status=403)
 
         # If we don't have a workflow, create one
-        if workflow:
-
-            # Remove old statuses here
-            workflow.workflowstatus_set.all().delete()
-
-        else:
+        if not workflow:
             # Add additional metadata to creation
             snakefile = request.POST.get("snakefile")
             workdir = request.POST.get("workdir")
@@ -97,24 +123,83 @@ class CreateWorkflow(RatelimitMixin, APIView):
             if user:
                 workflow.owners.add(user)
 
+        # Statuses go to the run started from snakeface, otherwise (e.g., a run
+        # from the command line) a new run, so earlier runs are kept as history
+        if workflow.status != "RUNNING":
+            workflow.new_run(user=user)
+
         data = {"id": workflow.id}
         return Response(status=200, data=data)
 
 
-class UpdateWorkflow(RatelimitMixin, APIView):
-    """Update an existing snakemake workflow. Authentication is required,
-    and the workflow must exist.
+class WorkflowQueue(RatelimitMixin, APIView):
+    """Return the run queue, meaning queued workflow runs in the order they will
+    be started, with the position and seconds waited. If the server requires
+    authentication, only the runs queued by the user are included.
+    """
+
+    ratelimit_key = "ip"
+    ratelimit_rate = settings.VIEW_RATE_LIMIT
+    ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
+    ratelimit_method = "GET"
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request):
+        print("GET /api/queue")
+
+        queue = run_queue.get_queue()
+        if cfg.REQUIRE_AUTH:
+            user, response_code = check_user_authentication(request)
+            if not user:
+                return Response(status=response_code)
+            queue = [x for x in queue if x["user"] == user.id]
+
+        # Optionally filter to one workflow
+        workflow = request.GET.get("id")
+        if workflow:
+            queue = [x for x in queue if str(x["id"]) == workflow]
+
+        data = {"running": len(run_queue.running), "queued": queue}
+        return Response(status=200, data=data)
+
+
+class IngestStats(RatelimitMixin, APIView):
+    """Return the depth of the status write-behind buffer, and counts and
+    latencies (milliseconds from accepted to added) for ingestion.
     """
 
     ratelimit_key = "ip"
     ratelimit_rate = settings.VIEW_RATE_LIMIT
     ratelimit_block = settings.VIEW_RATE_LIMIT_BLOCK
-    ratelimit_method = "POST"
+    ratelimit_method = "GET"
+    renderer_classes = (JSONRenderer,)
+
+    def get(self, request):
+        print("GET /api/ingest")
+
+        if cfg.REQUIRE_AUTH:
+            user, response_code = check_user_authentication(request)
+            if not user:
+                return Response(status=response_code)
+        return Response(status=200, data=status_buffer.stats())
+
+
+class UpdateWorkflow(APIView):
+    """Update an existing snakemake workflow. Authentication is required,
+    and the workflow must exist. Monitor endpoints are rate limited per
+    token and workflow (see throttle.py) instead of per ip address.
+    """
+
     renderer_classes = (JSONRenderer,)
 
     def post(self, request):
         print("POST /update_workflow_status")
 
+        counts = {str(request.POST.get("id")): 1}
+        response = throttle_monitor(request, counts, authenticated=False)
+        if response:
+            return response
+
         # We must have an existing workflow to update
         workflow = get_object_or_404(Workflow, pk=request.POST.get("id"))
 
@@ -122,15 +207,101 @@ class UpdateWorkflow(RatelimitMixin, APIView):
         if cfg.REQUIRE_AUTH:
             user, response_code = check_user_authentication(request)
             if not user:
-                return Response(response_code)
+                return Response(status=response_code)
 
             # If we have a workflow, check that user has permission to use/update
-            if workflow and user not in workflow.owners.all():
-                return Response(403)
+            if workflow and not is_owner(workflow, user):
+                return Response(status=403)
+
+        # The workflow is only limited for requests that can update it
+        response = throttle_monitor(request, counts)
+        if response:
+            return response
 
         # The message should be json dump of attributes
         message = json.loads(request.POST.get("msg", {}))
 
         # Update the workflow with a new status message
-        WorkflowStatus.objects.create(workflow=workflow, msg=message)
+        status = WorkflowStatus.from_message(
+            message, workflow=workflow, run_id=workflow.current_run_id
+        )
+        if status_buffer.enabled:
+            return add_buffered([status])
+        WorkflowStatus.add_batch([status])
+        workflow_events.send(workflow.id)
         return Response(status=200, data={})
+
+
+class UpdateWorkflowBatch(APIView):
+    """Add many status messages at once, optionally for several workflows.
+    The body is json with a list of messages, each with the workflow id and
+    the message (a json object, or a json string like for a single update):
+
+        {"messages": [{"id": 1, "msg": {...}}, {"id": 2, "msg": {...}}]}
+
+    A top level "id" is used for messages without one. Authentication and
+    permissions are checked once for the batch, and the statuses are added
+    in one transaction, so either all messages are added or none.
+    """
+
+    renderer_classes = (JSONRenderer,)
+
+    def post(self, request):
+        print("POST /update_workflow_statuses")
+
+        messages = request.data.get("messages")
+        if not isinstance(messages, list):
+            return Response(status=400, data={"message": "messages must be a list."})
+        if len(messages) > cfg.MAXIMUM_STATUS_BATCH:
+            return Response(
+                status=413,
+                data={"message": "At most %s messages." % cfg.MAXIMUM_STATUS_BATCH},
+            )
+
+        # Parse all messages before looking anything up
+        default_id = request.data.get("id")
+        parsed = []
+        try:
+            for message in messages:
+                parsed.append(parse_status(message, default_id))
+        except (AttributeError, TypeError, ValueError):
+            return Response(status=400, data={"message": "Invalid message."})
+
+        counts = collections.Counter(str(wid) for wid, _ in parsed)
+        response = throttle_monitor(request, counts, authenticated=False)
+        if response:
+            return response
+
+        # One query for the workflows (and their current runs)
+        ids = set(wid for wid, _ in parsed)
+        workflows = dict(
+            Workflow.objects.filter(id__in=ids).values_list("id", "current_run")
+        )
+        if len(workflows) != len(ids):
+            return Response(status=404)
+
+        # Does the server require authentication? One query for ownership
+        if cfg.REQUIRE_AUTH:
+            user, response_code = check_user_authentication(request)
+            if not user:
+                return Response(status=response_code)
+            owned = Workflow.owners.through.objects.filter(
+                workflow_id__in=ids, user=user
+            ).count()
+            if owned != len(ids):
+                return Response(status=403)
+
+        # The workflows are only limited for requests that can update them
+        response = throttle_monitor(request, counts)
+        if response:
+            return response
+
+        statuses = [
+            WorkflowStatus.from_message(msg, workflow_id=wid, run_id=workflows[wid])
+            for wid, msg in parsed
+        ]
+        if status_buffer.enabled:
+            return add_buffered(statuses, data={"created": len(statuses)})
+        WorkflowStatus.add_batch(statuses)
+        workflow_events.send(*ids)
+        return Response(status=200, data={"created": len(statuses)})
@@ -1,4 +1,6 @@
 from django import template
+from django.template.defaultfilters import filesizeformat
+from snakeface.apps.main.membership import is_member, is_owner
 
 register = template.Library()
 
@@ -21,3 +23,27 @@ def range(min=5):
 @register.filter
 def index(indexable, i):
     return indexable[i]
+
+
+@register.filter
+def split(string, sep=","):
+    return string.split(sep)
+
+
+@register.filter
+def filesizeformat_kb(kilobytes):
+    """Format a size in KB (e.g., max rss from rusage) as human readable"""
+    if kilobytes is None:
+        return ""
+    return filesizeformat(kilobytes * 1024)
+
+
+@register.filter(name="is_owner")
+def is_owner_filter(workflow, user):
+    """Determine if a user is an owner of a workflow (cached, see membership)"""
+    return is_owner(workflow, user)
+
+
+@register.filter(name="is_member")
+def is_member_filter(workflow, user):
+    return is_member(workflow, user)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from snakeface.apps.main.models import Workflow
+from snakeface.apps.main.models import Workflow, WorkflowRun
 
 
 class WorkflowAdmin(admin.ModelAdmin):
@@ -15,18 +15,47 @@ class WorkflowAdmin(admin.ModelAdmin):
         "command",
         "data",
         "dag",
-        "error",
-        "output",
         "name",
         "snakefile",
         "snakemake_id",
-        "status",
-        "thread",
-        "retval",
+        "priority",
+        "current_run",
         "workdir",
         "owners",
         "contributors",
     )
 
 
+class WorkflowRunAdmin(admin.ModelAdmin):
+    list_display = (
+        "workflow",
+        "status",
+        "add_date",
+        "retval",
+        "wall_time",
+        "cpu_time",
+        "max_rss",
+    )
+
+    fields = (
+        "workflow",
+        "user",
+        "command",
+        "status",
+        "priority",
+        "thread",
+        "pid",
+        "host",
+        "start_date",
+        "end_date",
+        "error",
+        "output",
+        "retval",
+        "cpu_time",
+        "max_rss",
+        "wall_time",
+    )
+
+
 admin.site.register(Workflow, WorkflowAdmin)
+admin.site.register(WorkflowRun, WorkflowRunAdmin)
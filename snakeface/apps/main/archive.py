@@ -0,0 +1,181 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+from snakeface.apps.main.supervisor import lock_file
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+import datetime
+import gzip
+import json
+import os
+import tempfile
+
+# The statuses of a run, one json object per line, in the run logs directory
+ARCHIVE_FILE = "statuses.jsonl.gz"
+
+# Locked while a run is archived
+ARCHIVE_LOCK = "archive.lock"
+
+# WorkflowStatus fields that are kept in the archive
+FIELDS = [
+    "id",
+    "msg",
+    "level",
+    "job",
+    "rule",
+    "text",
+    "level_class",
+    "traceback",
+    "html",
+]
+DATE_FIELDS = ["add_date", "modify_date", "timestamp"]
+
+
+def get_archive(run):
+    return os.path.join(run.logs_dir, ARCHIVE_FILE)
+
+
+def dump_status(status):
+    entry = {field: getattr(status, field) for field in FIELDS}
+    for field in DATE_FIELDS:
+        value = getattr(status, field)
+        entry[field] = value.isoformat() if value else None
+    return json.dumps(entry)
+
+
+def load_status(line, run):
+    from snakeface.apps.main.models import WorkflowStatus, get_display_fields
+
+    entry = json.loads(line)
+    for field in DATE_FIELDS:
+        if entry.get(field):
+            entry[field] = parse_datetime(entry[field])
+
+    # Archives written before display fields were stored
+    if "level_class" not in entry:
+        entry.update(get_display_fields(entry.get("level"), entry.get("text")))
+    return WorkflowStatus(workflow_id=run.workflow_id, run_id=run.id, **entry)
+
+
+def read_archive(run):
+    """Yield the (unsaved) statuses in the archive of a run, one line at a
+    time, so a large archive is never loaded at once.
+    """
+    if not run.archived_id:
+        return
+    with gzip.open(get_archive(run), "rt") as fd:
+        for line in fd:
+            yield load_status(line, run)
+
+
+def archive_run(run, chunk_size=1000):
+    """Move the statuses of a finished run into its archive. The statuses
+    are written in chunks to a new archive (after the statuses already in
+    it), which replaces the old one, then the run records the last archived
+    id, and only then are the rows deleted, also in chunks. Statuses up to
+    archived_id are always read from the archive, so if the rows aren't
+    deleted (e.g., the process is killed) they are deleted the next time.
+    The run is claimed with a lock file first, so a run that is being
+    archived (e.g., by the command and by clean_runs) is skipped. Returns the
+    number of statuses that were archived.
+    """
+    from snakeface.apps.main.models import WorkflowRun
+
+    lock = lock_file(os.path.join(run.logs_dir, ARCHIVE_LOCK))
+    if not lock:
+        return 0
+    try:
+        # Another process may have archived it before we took the lock
+        run.archived_id = (
+            WorkflowRun.objects.filter(pk=run.pk)
+            .values_list("archived_id", flat=True)
+            .first()
+        )
+        if run.archived_id is None:
+            return 0
+        return write_archive(run, chunk_size)
+    finally:
+        lock.close()
+
+
+def write_archive(run, chunk_size):
+    """Archive the statuses of a run that is claimed (see archive_run)"""
+    from snakeface.apps.main.models import WorkflowRun, WorkflowStatus
+
+    statuses = WorkflowStatus.objects.filter(run=run)
+    archive = get_archive(run)
+    last_id = run.archived_id
+    count = 0
+
+    if statuses.filter(id__gt=last_id).exists():
+        fd, tmpfile = tempfile.mkstemp(
+            prefix=ARCHIVE_FILE + ".", suffix=".tmp", dir=run.logs_dir
+        )
+        os.close(fd)
+        try:
+            with gzip.open(tmpfile, "wt") as fd:
+                if run.archived_id:
+                    with gzip.open(archive, "rt") as old:
+                        for line in old:
+                            fd.write(line)
+                while True:
+                    chunk = list(
+                        statuses.filter(id__gt=last_id).order_by("id")[:chunk_size]
+                    )
+                    if not chunk:
+                        break
+                    for status in chunk:
+                        fd.write(dump_status(status) + "\n")
+                    last_id = chunk[-1].id
+                    count += len(chunk)
+            os.rename(tmpfile, archive)
+        except BaseException:
+            os.remove(tmpfile)
+            raise
+        WorkflowRun.objects.filter(pk=run.pk).update(archived_id=last_id)
+        run.archived_id = last_id
+
+    # Rows that are in the archive
+    archived = statuses.filter(id__lte=run.archived_id)
+    while True:
+        ids = list(archived.values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            WorkflowStatus.objects.filter(id__in=ids).delete()
+    return count
+
+
+def archive_runs(workflow=None, days=None, chunk_size=1000):
+    """Archive the statuses of runs that finished more than days (by default
+    STATUS_ARCHIVE_DAYS) ago, optionally for one workflow. Runs that only
+    receive statuses from a monitor don't have an end date, so they are
+    archived by date added, unless they are still the current run. Returns
+    the number of runs with statuses that were archived.
+    """
+    from snakeface.apps.main.models import WorkflowRun, WorkflowStatus
+
+    days = cfg.STATUS_ARCHIVE_DAYS if days is None else days
+    if days is None:
+        return 0
+    before = timezone.now() - datetime.timedelta(days=days)
+    runs = (
+        WorkflowRun.objects.exclude(status__in=["RUNNING", "QUEUED"])
+        .filter(Q(end_date__lte=before) | Q(end_date=None, add_date__lte=before))
+        .exclude(end_date=None, workflow__current_run=F("id"))
+    )
+    if workflow is not None:
+        runs = runs.filter(workflow=workflow)
+
+    # Only runs with statuses in the database
+    rids = WorkflowStatus.objects.filter(run__in=runs).values("run").distinct()
+    archived = 0
+    for run in runs.filter(id__in=rids).order_by("id"):
+        if archive_run(run, chunk_size=chunk_size):
+            archived += 1
+    return archived
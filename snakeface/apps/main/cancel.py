@@ -0,0 +1,51 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+import os
+import threading
+
+# How often (seconds) a run checks for a cancel file written by another process
+CANCEL_CHECK_SECONDS = 0.25
+
+# Command runners for runs in this process, keyed by run id
+_runners = {}
+_lock = threading.Lock()
+
+
+def get_cancel_file(run):
+    """The cancel file lives with the run logs, so a new run starts clean"""
+    return os.path.join(run.logs_dir, "CANCEL")
+
+
+def register_runner(run, runner):
+    """Register the command runner for a run, so it can be cancelled directly"""
+    with _lock:
+        _runners[run.id] = runner
+
+
+def unregister_runner(run):
+    with _lock:
+        _runners.pop(run.id, None)
+
+
+def request_cancel(run):
+    """Signal a run to stop. If the run is in this process, the runner is
+    woken up right away. Otherwise (e.g., a cluster worker or another web
+    process) we write a cancel file that the run checks for.
+    """
+    with _lock:
+        runner = _runners.get(run.id)
+    if runner:
+        runner.cancel()
+        return
+
+    cancel_file = get_cancel_file(run)
+    os.makedirs(os.path.dirname(cancel_file), exist_ok=True)
+    with open(cancel_file, "w"):
+        pass
+
+
+def cancel_requested(run):
+    """Determine if a cancel file has been written for a run (no database)"""
+    return os.path.exists(get_cancel_file(run))
@@ -1,23 +1,43 @@
+import collections
 import json
 import asyncio
+import time
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from snakeface.apps.main.models import Workflow
-from snakeface.apps.main.tasks import serialize_workflow_statuses
+from django.db import transaction
+from snakeface.apps.main.models import Workflow, WorkflowRun, WorkflowStatus
+from snakeface.apps.main.events import workflow_events
+from snakeface.apps.main.ingest import status_buffer
+from snakeface.apps.main.streams import PROTOCOL_VERSION, workflow_streams
+from snakeface.apps.main.membership import is_owner
+from snakeface.apps.main.tasks import get_status_update
+from snakeface.apps.api.permissions import get_token_user
+from snakeface.apps.api.recorder import StreamRecorder
+from snakeface.apps.api.throttle import get_client_key, monitor_throttle
+from snakeface.apps.api.views import parse_status
 from snakeface.settings import cfg
 from asgiref.sync import sync_to_async
+from urllib.parse import parse_qs
 
 
-def get_statuses(workflow_id):
-    """Return a dictionary of workflow statuses on success. If the workflow
-    doesn't exist, then return False and we disconnect from the socket.
+def get_statuses(workflow_id, since=None, run=None):
+    """Return a dictionary of workflow statuses on success, only the ones
+    after the status id since if the client has the statuses of the run
+    (see get_status_update). If the workflow doesn't exist, then return
+    False and we disconnect from the socket.
     """
     try:
-        workflow = Workflow.objects.get(id=workflow_id)
+        workflow = Workflow.objects.select_related("current_run").get(id=workflow_id)
+        update = get_status_update(workflow, since, run)
+        run = workflow.current_run
         return {
-            "statuses": serialize_workflow_statuses(workflow),
-            "output": workflow.output,
-            "error": workflow.error,
-            "retval": workflow.retval,
+            "statuses": update["data"],
+            "last_id": update["last_id"],
+            "run": update["run"],
+            "reset": update["reset"],
+            "output": run.output_tail if run else None,
+            "error": run.error_tail if run else None,
+            "retval": run.retval if run else None,
         }
     except:
         return False
@@ -27,20 +47,110 @@ async_get_statuses = sync_to_async(get_statuses, thread_sensitive=True)
 
 
 class WorkflowConsumer(AsyncJsonWebsocketConsumer):
+    """Send the statuses (and output) of a workflow to its details page. The
+    page gets an update when it connects, and then only when there is an
+    event for the workflow (see events.py). Events that arrive within
+    WORKFLOW_PUSH_MS of each other are sent in one update.
+
+    A client that connects with ?v=2 gets frames of the workflow stream
+    (see streams.py): the statuses added since the last frame (the page adds
+    the ones its table page shows), and lines appended to the run output and
+    error, with a sequence number. To resume,
+    it connects with the stream id and the last sequence number it has
+    (?v=2&stream=<id>&seq=<seq>). Other clients get the statuses after the
+    status id since (and run), and the tails of the output and error.
+    """
+
     async def connect(self):
         self.workflow_id = self.scope["path"].strip("/").split("/")[-1]
         print("websocket connect for workflow %s" % self.workflow_id)
+
+        # The page sends the last status id (and run) it has, to get only new ones
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.since = query.get("since", [None])[0]
+        self.since = int(self.since) if (self.since or "").isdigit() else None
+        self.run = query.get("run", [None])[0]
         self.connected = True
+        self.scheduled = None
+        self.stream = None
+        self.lock = asyncio.Lock()
+        workflow_events.listen()
         await self.channel_layer.group_add(self.workflow_id, self.channel_name)
         await self.accept()
-        asyncio.create_task(self.update_workflow_status())
 
-    async def update_workflow_status(self):
-        while self.connected:
-            await asyncio.sleep(cfg.WORKFLOW_UPDATE_SECONDS)
+        version = query.get("v", ["1"])[0]
+        if version.isdigit() and int(version) >= PROTOCOL_VERSION:
+            await self.connect_stream(query)
+            return
+
+        # Anything added since the page loaded its statuses
+        await self.update_workflow_status()
+
+    async def connect_stream(self, query):
+        """Catch up the stream, and send the frames the client doesn't have,
+        or a snapshot if it can't resume
+        """
+        self.seq = None
+        self.stream = workflow_streams.subscribe(self.workflow_id, self)
+        await self.stream.update()
+        if not self.connected:
+            return
+
+        seq = query.get("seq", [""])[0]
+        resume = query.get("stream", [None])[0] == self.stream.id and seq.isdigit()
+        async with self.lock:
+            if resume and self.stream.frames_after(int(seq)) is not None:
+                self.seq = int(seq)
+            else:
+                self.seq, snapshot = await self.stream.snapshot()
+                await self.send(text_data=snapshot)
+        await self.send_frames()
+
+    async def send_frames(self):
+        """Send the frames of the stream after the last one sent"""
+        async with self.lock:
+            if self.seq is None or not self.connected:
+                return
+            frames = self.stream.frames_after(self.seq)
+
+            # Too far behind, start over from the current state
+            if frames is None:
+                self.seq, snapshot = await self.stream.snapshot()
+                frames = [snapshot]
+            elif frames:
+                self.seq = self.stream.seq
+            for frame in frames:
+                await self.send(text_data=frame)
 
+    async def close_missing(self):
+        self.connected = False
+        message = "Workflow with id %s does not exist." % self.workflow_id
+        await self.send_json({"v": PROTOCOL_VERSION, "missing": message})
+        await self.close()
+
+    async def workflow_event(self, event):
+        """Schedule an update, unless one is waiting to be sent"""
+        if self.stream:
+            self.stream.schedule()
+        elif self.connected and not self.scheduled:
+            self.scheduled = asyncio.create_task(self.send_scheduled())
+
+    async def send_scheduled(self):
+        await asyncio.sleep(cfg.WORKFLOW_PUSH_MS / 1000)
+
+        # Events from now on need another update
+        self.scheduled = None
+        if self.connected:
+            await self.update_workflow_status()
+
+    async def update_workflow_status(self):
+        """Send the statuses after the last update, one update at a time"""
+        async with self.lock:
             status = "success"
-            data = await async_get_statuses(self.workflow_id)
+            data = await async_get_statuses(self.workflow_id, self.since, self.run)
+            if data:
+                self.since = data["last_id"]
+                self.run = data["run"]
             if data == False:
                 data = {
                     "message": "Workflow with id %s does not exist." % self.workflow_id
@@ -54,6 +164,10 @@ class WorkflowConsumer(AsyncJsonWebsocketConsumer):
 
     async def disconnect(self, close_code):
         self.connected = False
+        if self.scheduled:
+            self.scheduled.cancel()
+        if self.stream:
+            workflow_streams.unsubscribe(self.workflow_id, self)
         await self.channel_layer.group_discard(self.workflow_id, self.channel_name)
 
     async def receive(self, text_data):
@@ -65,3 +179,373 @@ class WorkflowConsumer(AsyncJsonWebsocketConsumer):
         await self.channel_layer.group_send(
             self.room_group_name, {"type": "chat_message", "message": message}
         )
+
+
+# Ingestion
+
+
+def get_ingest_run(workflow_id, key, run_id=None):
+    """Authenticate a monitor client, and return the run to add statuses to
+    (and the last sequence number added), or an error message. Without a
+    run id, this is the current run of the workflow (a new run if there
+    isn't one).
+    """
+    user = None
+    if cfg.REQUIRE_AUTH:
+        user = get_token_user(key) if key else None
+        if not user:
+            return "Authentication is required."
+    workflow = Workflow.objects.filter(pk=workflow_id).first()
+    if not workflow:
+        return "Workflow with id %s does not exist." % workflow_id
+    if user and not is_owner(workflow, user):
+        return "You do not have permission to update this workflow."
+
+    if run_id:
+        run = WorkflowRun.objects.filter(pk=run_id, workflow=workflow).first()
+        if not run:
+            return "Run %s of workflow %s does not exist." % (run_id, workflow_id)
+    else:
+        run = workflow.current_run or workflow.new_run(user=user)
+    return run.id, run.last_seq
+
+
+def save_statuses(workflow_id, run_id, messages):
+    """Add statuses for a list of (seq, msg), and record the last sequence
+    number in the same transaction, so a resumed stream has no duplicates.
+    The run is locked first, since another socket for it (e.g., a reconnect
+    that overlaps the old one) may have added some of them already, and the
+    last sequence number only moves forward. Returns the last sequence
+    number of the run.
+    """
+    with transaction.atomic():
+        run = WorkflowRun.objects.select_for_update().only("last_seq").get(pk=run_id)
+        messages = [(seq, msg) for seq, msg in messages if seq > run.last_seq]
+        if not messages:
+            return run.last_seq
+        WorkflowStatus.add_batch(
+            [
+                WorkflowStatus.from_message(msg, workflow_id=workflow_id, run_id=run_id)
+                for _, msg in messages
+            ]
+        )
+        last_seq = messages[-1][0]
+        WorkflowRun.objects.filter(pk=run_id, last_seq__lt=last_seq).update(
+            last_seq=last_seq
+        )
+    workflow_events.send(workflow_id)
+    return last_seq
+
+
+async_get_ingest_run = sync_to_async(get_ingest_run, thread_sensitive=True)
+async_save_statuses = sync_to_async(save_statuses, thread_sensitive=True)
+
+
+class IngestConsumer(AsyncJsonWebsocketConsumer):
+    """A monitor client opens one socket per run, and sends status messages
+    with increasing sequence numbers, one {"seq": 1, "msg": {...}} or a list
+    as {"messages": [...]}. The token is in an Authorization header, or a
+    token query parameter, and ?run= resumes a specific run. On connect we
+    send the last sequence number that was added, and messages up to it are
+    ignored, so a client can resend from there after a reconnect. Statuses
+    are added in batches (every STATUS_FLUSH_MS, or STATUS_FLUSH_COUNT
+    messages), and each batch is acknowledged with its last sequence number
+    once it is saved.
+    """
+
+    async def connect(self):
+        self.workflow_id = self.scope["url_route"]["kwargs"]["wid"]
+        params = parse_qs(self.scope["query_string"].decode("utf-8"))
+        headers = dict(self.scope.get("headers", []))
+        key = headers.get(b"authorization", b"").decode("utf-8").split(" ")[-1]
+        key = key or params.get("token", [None])[0]
+        address = self.scope.get("client", [None])[0]
+        self.client = get_client_key(key, address)
+
+        await self.accept()
+        if monitor_throttle.check_address(address):
+            message = "Too many connections, try again later."
+            await self.send_json({"type": "error", "message": message})
+            await self.close(code=4029)
+            return
+        found = await async_get_ingest_run(
+            self.workflow_id, key, params.get("run", [None])[0]
+        )
+        if isinstance(found, str):
+            await self.send_json({"type": "error", "message": found})
+            await self.close(code=4003)
+            return
+
+        print("websocket ingest for workflow %s" % self.workflow_id)
+        self.run_id, self.last_seq = found
+        self.received_seq = self.last_seq
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.flusher = asyncio.create_task(self.flush_periodically())
+        await self.send_json(
+            {"type": "hello", "run": self.run_id, "last_seq": self.last_seq}
+        )
+
+    async def receive_json(self, content):
+        if not hasattr(self, "pending"):
+            return
+        messages = (
+            content.get("messages", [content]) if isinstance(content, dict) else []
+        )
+        if not isinstance(messages, list):
+            messages = []
+
+        for message in messages:
+            seq = message.get("seq") if isinstance(message, dict) else None
+            msg = message.get("msg") if isinstance(message, dict) else None
+            if not isinstance(seq, int) or not isinstance(msg, (dict, str)):
+                await self.send_json(
+                    {"type": "error", "seq": seq, "message": "Invalid message."}
+                )
+                continue
+
+            # Already added (or received), e.g., resent after a reconnect
+            if seq <= self.received_seq:
+                continue
+            if isinstance(msg, str):
+                try:
+                    msg = json.loads(msg)
+                except ValueError:
+                    await self.send_json(
+                        {"type": "error", "seq": seq, "message": "Invalid message."}
+                    )
+                    continue
+            self.pending.append((seq, msg))
+            self.received_seq = seq
+
+        if len(self.pending) >= cfg.STATUS_FLUSH_COUNT:
+            await self.flush()
+        elif not self.pending:
+            await self.send_json({"type": "ack", "seq": self.last_seq})
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(cfg.STATUS_FLUSH_MS / 1000)
+            await self.flush()
+
+    async def flush(self, ack=True):
+        """Save pending statuses, and acknowledge the last sequence number.
+        Over the monitor rate limits we wait (and don't acknowledge) first,
+        which slows down the client.
+        """
+        async with self.lock:
+            if not self.pending:
+                return
+            messages, self.pending = self.pending, []
+            counts = {str(self.workflow_id): len(messages)}
+            wait = monitor_throttle.check(self.client, counts)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = monitor_throttle.check(self.client, counts)
+
+            self.last_seq = await async_save_statuses(
+                self.workflow_id, self.run_id, messages
+            )
+            if ack:
+                await self.send_json({"type": "ack", "seq": self.last_seq})
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, "pending"):
+            return
+        self.flusher.cancel()
+
+        # Save what we received, a client that reconnects resumes after it
+        await self.flush(ack=False)
+
+
+def get_stream_workflow(workflow_id, user):
+    """Return the current run id of a workflow to add streamed statuses to,
+    and an error message if it doesn't exist or the user isn't an owner
+    """
+    found = Workflow.objects.filter(pk=workflow_id).values_list("current_run").first()
+    if not found:
+        return None, "Workflow %s does not exist." % workflow_id
+    if user and not is_owner(workflow_id, user):
+        return None, "You do not have permission to update workflow %s." % workflow_id
+    return found[0], None
+
+
+def add_stream_statuses(messages):
+    """Add statuses for a list of (workflow id, run id, msg), to the
+    write-behind buffer if it's enabled. Returns False if the buffer is full.
+    """
+    statuses = [
+        WorkflowStatus.from_message(msg, workflow_id=wid, run_id=run_id)
+        for wid, run_id, msg in messages
+    ]
+    if status_buffer.enabled:
+        return status_buffer.put(statuses)
+    WorkflowStatus.add_batch(statuses)
+    workflow_events.send(*set(wid for wid, _, _ in messages))
+    return True
+
+
+async_get_token_user = sync_to_async(get_token_user, thread_sensitive=True)
+async_get_stream_workflow = sync_to_async(get_stream_workflow, thread_sensitive=True)
+async_add_stream_statuses = sync_to_async(add_stream_statuses, thread_sensitive=True)
+
+
+class StreamIngestConsumer(AsyncHttpConsumer):
+    """Add status messages from a (chunked) application/x-ndjson POST body,
+    so a run can send its statuses over one long-lived request. Each line is
+    a json object like a batch message, {"id": 1, "msg": {...}}, and the id
+    defaults to an id query parameter. The body is parsed a chunk at a time
+    as the server hands it over (the end of a line split across chunks is
+    kept for the next one), and statuses are added every
+    MAXIMUM_STATUS_BATCH lines, so memory use doesn't depend on the length
+    of the stream. A line that isn't valid (or is for a workflow that
+    doesn't exist or isn't owned) is reported in the summary that is sent
+    when the body ends, and doesn't stop the stream. Over the rate limits
+    (or with the write-behind buffer full) we wait before reading on.
+
+    Servers that pass on the body as it arrives (e.g., uvicorn) make this
+    incremental, while daphne (and so runserver) receives the whole body
+    before passing it on. The IngestConsumer websocket streams with any.
+    """
+
+    # Longer lines are reported as errors (and skipped), and at most this
+    # many errors are listed in the summary (all are counted)
+    max_line_length = 1024 * 1024
+    max_errors = 100
+
+    async def http_request(self, message):
+        if not hasattr(self, "summary"):
+            error = await self.start()
+            if error:
+                await self.send_summary(error[0], {"message": error[1]})
+                return await self.http_disconnect(message)
+
+        # Chunks are recorded as they arrive (MONITOR_RECORD_DIRECTORY)
+        chunk = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        received = time.time()
+        if self.recorder and more_body:
+            self.recorder.write(received, chunk, more_body)
+        for number, line in self.split_lines(chunk, more_body):
+            await self.add_line(number, line)
+        if not more_body:
+            await self.add_statuses()
+            await self.send_summary(200, self.summary)
+            if self.recorder:
+                self.recorder.write(received, chunk, more_body, status=200)
+            await self.http_disconnect(message)
+
+    async def start(self):
+        """Authenticate the client, and start the summary. Returns the status
+        and message of an error response, or None.
+        """
+        print("POST /stream_workflow_statuses")
+        if self.scope["method"] != "POST":
+            return 405, "Method not allowed."
+
+        params = parse_qs(self.scope["query_string"].decode("utf-8"))
+        headers = dict(self.scope.get("headers", []))
+        key = headers.get(b"authorization", b"").decode("utf-8").split(" ")[-1]
+        key = key or params.get("token", [None])[0]
+        address = self.scope.get("client", [None])[0]
+        self.client = get_client_key(key, address)
+        if monitor_throttle.check_address(address):
+            return 429, "Too many requests, try again later."
+        self.user = None
+        if cfg.REQUIRE_AUTH:
+            self.user = await async_get_token_user(key) if key else None
+            if not self.user:
+                return 401, "Authentication is required."
+
+        self.default_id = params.get("id", [None])[0]
+        self.recorder = (
+            StreamRecorder(self.scope) if cfg.MONITOR_RECORD_DIRECTORY else None
+        )
+        self.summary = {"lines": 0, "created": 0, "error_count": 0, "errors": []}
+        self.workflows = {}
+        self.pending = []
+        self.number = 0
+        self.partial = b""
+        self.skipping = False
+
+    def split_lines(self, chunk, more_body):
+        """Yield (line number, line) for the lines that end in a chunk of the
+        body, starting with the end of a line from earlier chunks. With the
+        last chunk, a final line without a newline is included. A line that
+        is too long is yielded as None.
+        """
+        lines = chunk.split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            self.number += 1
+            line, self.partial = self.partial + line, b""
+            if self.skipping or len(line) > self.max_line_length:
+                self.skipping = False
+                yield self.number, None
+                continue
+            yield self.number, line
+
+        # Keep the start of the next line, unless it's already too long
+        if not self.skipping:
+            self.partial += rest
+            if len(self.partial) > self.max_line_length:
+                self.partial, self.skipping = b"", True
+        if not more_body and (self.partial or self.skipping):
+            self.number += 1
+            yield self.number, None if self.skipping else self.partial
+
+    async def add_line(self, number, line):
+        self.summary["lines"] = number
+        if line is None:
+            return self.add_error(
+                number, "Line is longer than %s bytes." % self.max_line_length
+            )
+        if not line.strip():
+            return
+        try:
+            wid, msg = parse_status(json.loads(line), self.default_id)
+        except (AttributeError, TypeError, ValueError):
+            return self.add_error(number, "Invalid message.")
+
+        # Look up (once) the current run of each workflow
+        if wid not in self.workflows:
+            self.workflows[wid] = await async_get_stream_workflow(wid, self.user)
+        run_id, error = self.workflows[wid]
+        if error:
+            return self.add_error(number, error)
+        self.pending.append((wid, run_id, msg))
+        if len(self.pending) >= cfg.MAXIMUM_STATUS_BATCH:
+            await self.add_statuses()
+
+    def add_error(self, number, message):
+        self.summary["error_count"] += 1
+        if len(self.summary["errors"]) < self.max_errors:
+            self.summary["errors"].append({"line": number, "message": message})
+
+    async def add_statuses(self):
+        """Add the pending statuses, waiting first if we are over the rate
+        limits (or the write-behind buffer is full) to slow down the stream.
+        """
+        if not self.pending:
+            return
+        messages, self.pending = self.pending, []
+        counts = collections.Counter(str(wid) for wid, _, _ in messages)
+        wait = monitor_throttle.check(self.client, counts)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = monitor_throttle.check(self.client, counts)
+        while not await async_add_stream_statuses(messages):
+            await asyncio.sleep(status_buffer.retry_after())
+        self.summary["created"] += len(messages)
+
+    async def send_summary(self, status, data):
+        await self.send_response(
+            status,
+            json.dumps(data).encode("utf-8"),
+            headers=[(b"Content-Type", b"application/json")],
+        )
+
+    async def disconnect(self):
+        """Add what we received if the client goes away before the end"""
+        if getattr(self, "pending", None):
+            await self.add_statuses()
@@ -0,0 +1,184 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from django.db import connection, migrations
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+from django.db.models import Q
+
+from snakeface.apps.main.models import (
+    DISPLAY_COLUMNS,
+    MESSAGE_COLUMNS,
+    extract_message,
+    get_message,
+)
+
+import os
+import sys
+
+
+def backfill_status_fields(apps, schema_editor, chunk_size=1000):
+    """Extract the columns (and display fields) for statuses added before
+    they existed. Statuses without a level or level class are checked, and
+    only the ones with something to extract are updated.
+    """
+    WorkflowStatus = apps.get_model("main", "WorkflowStatus")
+    statuses = WorkflowStatus.objects.using(schema_editor.connection.alias)
+    columns = [column for _, column in MESSAGE_COLUMNS] + DISPLAY_COLUMNS
+    missing = Q(level__isnull=True) | Q(level_class__isnull=True)
+    last_id = 0
+    updated = 0
+    while True:
+        chunk = list(
+            statuses.filter(missing, id__gt=last_id).order_by("id")[:chunk_size]
+        )
+        if not chunk:
+            break
+        last_id = chunk[-1].id
+        changed = []
+        for status in chunk:
+            fields, msg = extract_message(get_message(status))
+            if msg == status.msg and all(
+                getattr(status, column) == value for column, value in fields.items()
+            ):
+                continue
+            for column, value in fields.items():
+                setattr(status, column, value)
+            status.msg = msg
+            changed.append(status)
+        if changed:
+            statuses.bulk_update(changed, columns + ["msg"], batch_size=500)
+            updated += len(changed)
+    if updated:
+        print("Extracted message fields for %s workflow statuses." % updated)
+
+
+# Fields of a workflow that moved to its runs (see create_workflow_runs)
+RUN_FIELDS = ["output", "error", "status", "thread", "retval"]
+
+
+def create_workflow_runs(apps, schema_editor):
+    """Workflows from before runs were kept had the state of their last run
+    (status, output, error, thread and return value) on the workflow, and
+    statuses without a run. Each workflow without a current run gets a run
+    with that state and its statuses. A run that was running (or queued)
+    stopped with the server, so it's saved as cancelled.
+    """
+    Workflow = apps.get_model("main", "Workflow")
+    WorkflowRun = apps.get_model("main", "WorkflowRun")
+    WorkflowStatus = apps.get_model("main", "WorkflowStatus")
+    alias = schema_editor.connection.alias
+    created = 0
+    for workflow in Workflow.objects.using(alias).filter(current_run=None):
+        fields = {name: getattr(workflow, name, None) for name in RUN_FIELDS}
+        if fields["status"] in [None, "RUNNING", "QUEUED"]:
+            fields["status"] = "CANCELLED" if fields["status"] else "NOTRUNNING"
+        run = WorkflowRun.objects.using(alias).create(
+            workflow=workflow, command=workflow.command, **fields
+        )
+        WorkflowRun.objects.using(alias).filter(pk=run.pk).update(
+            add_date=workflow.add_date
+        )
+        WorkflowStatus.objects.using(alias).filter(workflow=workflow, run=None).update(
+            run=run
+        )
+        Workflow.objects.using(alias).filter(pk=workflow.pk).update(current_run=run)
+        created += 1
+    if created:
+        print("Created runs for %s workflows." % created)
+
+
+# Data migrations of the main app, by name (after the number), in order
+DATA_MIGRATIONS = {
+    "create_workflow_runs": create_workflow_runs,
+    "backfill_status_fields": backfill_status_fields,
+}
+
+# Fields (model, names) that a data migration reads, but the models don't
+# have any more. They are removed after it runs (see split_removals).
+REMOVED_FIELDS = {"create_workflow_runs": ("workflow", RUN_FIELDS)}
+
+
+def split_removals(loader, app, model, fields):
+    """If the latest migration of an app isn't applied yet and removes
+    fields of a model, move the removals to a migration of their own, and
+    return the (app, name) of the migration before them and the removal
+    migration. Otherwise, the fields are already gone (or were never
+    there), and None is returned.
+    """
+    leaves = loader.graph.leaf_nodes(app)
+    if len(leaves) != 1 or leaves[0] in loader.applied_migrations:
+        return
+    migration = loader.disk_migrations[leaves[0]]
+    removals = [
+        operation
+        for operation in migration.operations
+        if isinstance(operation, migrations.RemoveField)
+        and operation.model_name_lower == model
+        and operation.name_lower in fields
+    ]
+    if not removals:
+        return
+
+    # Indexes can come before a field they are on (e.g., the run of a status)
+    indexes = [x for x in migration.operations if isinstance(x, migrations.AddIndex)]
+    migration.operations = [
+        x for x in migration.operations if x not in removals and x not in indexes
+    ] + indexes
+    write_migration(migration)
+
+    # migrate (in this process) needs to import the new file
+    sys.modules.pop(type(migration).__module__, None)
+
+    # The removals are written after the data migration
+    removal = migrations.Migration("remove_%s_fields" % model, app)
+    removal.operations = removals
+    return leaves[0], removal
+
+
+def write_migration(migration):
+    writer = MigrationWriter(migration)
+    with open(writer.path, "w") as fd:
+        fd.write(writer.as_string())
+    print("Wrote migration %s" % os.path.basename(writer.path))
+
+
+def write_data_migrations(app="main"):
+    """Migrations are generated when snakeface starts (see client.py), so
+    data migrations can't be shipped as files. After makemigrations, this
+    writes a migration for each data migration that the app doesn't have
+    yet, after the latest one, so it runs once (with migrate) on a database
+    that has the columns it needs. A data migration that reads fields the
+    models no longer have runs before the migration that removes them.
+    """
+    loader = MigrationLoader(connection, ignore_no_migrations=True)
+    names = [name for label, name in loader.disk_migrations if label == app]
+
+    def next_name(suffix):
+        numbers = [int(name[:4]) for name in names if name[:4].isdigit()]
+        return "%04d_%s" % (max(numbers, default=0) + 1, suffix)
+
+    for suffix, func in DATA_MIGRATIONS.items():
+        if any(name.split("_", 1)[-1] == suffix for name in names):
+            continue
+        leaves = loader.graph.leaf_nodes(app)
+        if not leaves:
+            continue
+        removal = None
+        if suffix in REMOVED_FIELDS:
+            split = split_removals(loader, app, *REMOVED_FIELDS[suffix])
+            if split:
+                leaf, removal = split
+                leaves = [leaf]
+        migration = migrations.Migration(next_name(suffix), app)
+        migration.dependencies = leaves
+        migration.operations = [migrations.RunPython(func, migrations.RunPython.noop)]
+        write_migration(migration)
+        names.append(migration.name)
+        if removal:
+            removal.name = next_name(removal.name)
+            removal.dependencies = [(app, migration.name)]
+            write_migration(removal)
+            names.append(removal.name)
+        loader.build_graph()
@@ -0,0 +1,59 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+import asyncio
+
+
+class WorkflowEvents(object):
+    """Push an event to the pages viewing a workflow when something changes
+    (statuses were added, the run wrote output, or a run started or
+    finished), through the channel layer group of their WorkflowConsumers.
+    A consumer only queries the database when it gets an event, so an idle
+    workflow costs nothing. The in memory channel layer only reaches
+    consumers in this process, and is sent to on their event loop, so
+    events from other threads (views, the status buffer, runners) are handed
+    to that loop without waiting. Other layers (e.g., redis) are sent to
+    directly.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.sent = 0
+
+    def __str__(self):
+        return "[workflow-events:%s sent]" % self.sent
+
+    def __repr__(self):
+        return self.__str__()
+
+    def listen(self):
+        """Called by a consumer when it connects, on its event loop"""
+        self.loop = asyncio.get_running_loop()
+
+    async def asend(self, workflow_ids):
+        layer = get_channel_layer()
+        for workflow_id in workflow_ids:
+            await layer.group_send(str(workflow_id), {"type": "workflow.event"})
+        self.sent += len(workflow_ids)
+
+    def send(self, *workflow_ids):
+        """Send an event for one or more workflows, from synchronous code"""
+        workflow_ids = set(x for x in workflow_ids if x is not None)
+        layer = get_channel_layer()
+        if not workflow_ids or layer is None:
+            return
+        if not isinstance(layer, InMemoryChannelLayer):
+            async_to_sync(self.asend)(workflow_ids)
+            return
+
+        # Without a consumer in this process, no one is listening
+        if not self.loop or self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.asend(workflow_ids), self.loop)
+
+
+workflow_events = WorkflowEvents()
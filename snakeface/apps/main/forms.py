@@ -17,6 +17,6 @@ class WorkflowForm(ModelForm):
 
         # Notebooks are always implicitly private, there is only one user
         if cfg.NOTEBOOK:
-            fields = ["name", "workdirs"]
+            fields = ["name", "workdirs", "priority"]
         else:
-            fields = ["name", "workdirs", "private"]
+            fields = ["name", "workdirs", "private", "priority"]
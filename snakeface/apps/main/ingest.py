@@ -0,0 +1,244 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+from snakeface.apps.main.events import workflow_events
+from django.db import close_old_connections
+
+import atexit
+import collections
+import math
+import os
+import signal
+import threading
+import time
+
+
+class StatusBuffer(object):
+    """A write-behind buffer for workflow statuses. Accepted statuses go into
+    a bounded in-memory queue, and a background flusher adds them with one
+    bulk_create every STATUS_FLUSH_MS milliseconds, or as soon as
+    STATUS_FLUSH_COUNT statuses are waiting. Requests then don't wait on
+    (or hold) the database write lock. When the queue is full, put returns
+    False and the caller should ask the client to retry later. A batch that
+    fails to be added is put back at the head of the queue and retried, with
+    a backoff that doubles up to max_backoff seconds. After max_retries
+    failures in a row, its statuses are added one at a time, and only the
+    ones that still fail are dropped. The queue is flushed when the process
+    exits (and on SIGTERM, see stop_on), and statuses put after that are
+    rejected, since nothing would add them.
+    """
+
+    max_retries = 5
+    max_backoff = 30
+
+    def __init__(self, size=None, flush_ms=None, flush_count=None):
+        self.size = size or cfg.STATUS_BUFFER_SIZE
+        self.flush_ms = flush_ms or cfg.STATUS_FLUSH_MS
+        self.flush_count = flush_count or cfg.STATUS_FLUSH_COUNT
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+        # Flushes that failed in a row
+        self.retries = 0
+
+        # Counters and timings for stats
+        self.accepted = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.retried = 0
+        self.flushes = 0
+        self.last_flush = None
+        self.flush_seconds = 0
+        self.latency_max = 0
+        self.latency_total = 0
+
+    def __str__(self):
+        return "[status-buffer:%s/%s]" % (len(self.queue), self.size)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def enabled(self):
+        return bool(cfg.STATUS_BUFFER)
+
+    def put(self, statuses):
+        """Add a list of (unsaved) WorkflowStatus to the queue. A list is
+        accepted whole or not at all. Returns False if the queue is full (or
+        the buffer was stopped).
+        """
+        now = time.time()
+        with self.condition:
+            if self.stopped or len(self.queue) + len(statuses) > self.size:
+                self.rejected += len(statuses)
+                return False
+            self.queue.extend((status, now) for status in statuses)
+            self.accepted += len(statuses)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if len(self.queue) >= self.flush_count:
+                self.condition.notify()
+        return True
+
+    def retry_after(self):
+        """Estimate the seconds until the queue has room, for Retry-After"""
+        flushes = len(self.queue) / self.flush_count
+        return max(1, math.ceil(flushes * self.flush_ms / 1000))
+
+    def get_backoff(self):
+        """Seconds to wait before retrying a batch that failed"""
+        return min(self.max_backoff, self.flush_ms / 1000 * 2 ** self.retries)
+
+    def run(self):
+        """Flush the queue until the buffer is stopped"""
+        while True:
+            with self.condition:
+                if self.retries:
+                    deadline = time.time() + self.get_backoff()
+                    while not self.stopped and time.time() < deadline:
+                        self.condition.wait(timeout=deadline - time.time())
+                elif len(self.queue) < self.flush_count and not self.stopped:
+                    self.condition.wait(timeout=self.flush_ms / 1000)
+                if self.stopped and not self.queue:
+                    break
+            self.flush()
+        close_old_connections()
+
+    def flush(self):
+        """Add up to STATUS_FLUSH_COUNT statuses to the database at once"""
+        from snakeface.apps.main.models import WorkflowStatus
+
+        with self.condition:
+            count = min(len(self.queue), self.flush_count)
+            batch = [self.queue.popleft() for _ in range(count)]
+        if not batch:
+            return
+
+        start = time.time()
+        try:
+            WorkflowStatus.add_batch([status for status, _ in batch])
+        except Exception as e:
+            self.reset(batch)
+            with self.condition:
+                self.retries += 1
+                retry = self.retries <= self.max_retries
+                if retry:
+                    print(
+                        "Failed to add %s statuses, retrying in %.1f seconds: %s"
+                        % (len(batch), 0 if self.stopped else self.get_backoff(), e)
+                    )
+                    self.retried += len(batch)
+                    self.queue.extendleft(reversed(batch))
+                else:
+                    self.retries = 0
+            if retry:
+                return
+            print(
+                "Failed to add %s statuses, adding one at a time: %s" % (len(batch), e)
+            )
+            batch = self.add_each(batch)
+            if not batch:
+                return
+
+        workflow_events.send(*set(status.workflow_id for status, _ in batch))
+        done = time.time()
+        with self.condition:
+            self.retries = 0
+            self.flushes += 1
+            self.flushed += len(batch)
+            self.last_flush = done
+            self.flush_seconds = done - start
+            for _, queued in batch:
+                self.latency_total += done - queued
+            self.latency_max = max(self.latency_max, done - batch[0][1])
+
+    def reset(self, batch):
+        """After a batch failed, get a new connection, and clear the ids that
+        bulk_create may have set for a part of it that was rolled back
+        """
+        close_old_connections()
+        for status, _ in batch:
+            status.pk = None
+
+    def add_each(self, batch):
+        """Add the statuses of a batch (that keeps failing) one at a time, so
+        that a bad one doesn't take the others (e.g., of other workflows)
+        with it. Returns the ones that were added, the others are dropped.
+        """
+        from snakeface.apps.main.models import WorkflowStatus
+
+        added = []
+        error = None
+        for status, queued in batch:
+            try:
+                WorkflowStatus.add_batch([status])
+            except Exception as e:
+                self.reset([(status, queued)])
+                error = e
+                continue
+            added.append((status, queued))
+        dropped = len(batch) - len(added)
+        if dropped:
+            print("Failed to add %s statuses, dropped: %s" % (dropped, error))
+            with self.condition:
+                self.failed += dropped
+        return added
+
+    def stop(self):
+        """Flush everything that is queued, and stop the flusher"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            thread = self.thread
+        if thread:
+            thread.join()
+
+    def stop_on(self, signum):
+        """Flush the queue when the process gets a signal (e.g., SIGTERM, when
+        atexit handlers don't run), then handle it as before. Signal handlers
+        can only be set from the main thread, otherwise this does nothing.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signum)
+
+        def handler(number, frame):
+            self.stop()
+            if callable(previous):
+                previous(number, frame)
+            elif previous != signal.SIG_IGN:
+                signal.signal(number, signal.SIG_DFL)
+                os.kill(os.getpid(), number)
+
+        signal.signal(signum, handler)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "enabled": self.enabled,
+                "depth": len(self.queue),
+                "size": self.size,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "retries": self.retries,
+                "flushes": self.flushes,
+                "last_flush": self.last_flush,
+                "last_flush_ms": round(self.flush_seconds * 1000, 2),
+                "latency_avg_ms": round(
+                    self.latency_total / self.flushed * 1000 if self.flushed else 0, 2
+                ),
+                "latency_max_ms": round(self.latency_max * 1000, 2),
+            }
+
+
+status_buffer = StatusBuffer()
+atexit.register(status_buffer.stop)
@@ -0,0 +1,175 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+
+import os
+import re
+import struct
+import threading
+
+# Each index entry is (line number, segment number, byte offset in segment)
+INDEX_ENTRY = struct.Struct("<QIQ")
+
+
+class RunLog(object):
+    """An append-only log for one stream (stdout or stderr) of a workflow run.
+    Lines are written to numbered segment files as they arrive, and a sparse
+    index records the segment and byte offset of every index_every-th line,
+    so that any line (and the tail) can be found without reading the whole
+    log. Only counters are kept in memory, so memory use does not grow with
+    the length of the run.
+    """
+
+    def __init__(self, root, stream="stdout", segment_size=None, index_every=1000):
+        self.root = root
+        self.stream = stream
+        self.segment_size = segment_size or cfg.LOG_SEGMENT_SIZE
+        self.index_every = index_every
+        self.lock = threading.Lock()
+        self._fd = None
+        self._index = None
+
+    def __str__(self):
+        return "[run-log:%s:%s]" % (self.stream, self.root)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def index_file(self):
+        return os.path.join(self.root, "%s.idx" % self.stream)
+
+    def segment_file(self, segment):
+        return os.path.join(self.root, "%s.%05d.log" % (self.stream, segment))
+
+    def segments(self):
+        """Return the sorted list of segment numbers that exist on disk."""
+        if not os.path.exists(self.root):
+            return []
+        regex = re.compile("^%s[.](?P<segment>[0-9]+)[.]log$" % self.stream)
+        found = [regex.match(x) for x in os.listdir(self.root)]
+        return sorted(int(x.group("segment")) for x in found if x)
+
+    def position(self):
+        """The last segment and its size, which change when lines are added"""
+        segments = self.segments()
+        if not segments:
+            return None
+        return segments[-1], os.path.getsize(self.segment_file(segments[-1]))
+
+    # Writing
+
+    def open(self):
+        """Open the log for appending, picking up where an existing log ended."""
+        os.makedirs(self.root, exist_ok=True)
+        self.line_count = self.count()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self._fd = open(self.segment_file(self.segment), "ab")
+        self._index = open(self.index_file, "ab")
+        self.size = self._fd.tell()
+        return self
+
+    def append(self, line):
+        """Append a single line, flushing so that readers see it right away."""
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        if not line.endswith(b"\n"):
+            line += b"\n"
+
+        with self.lock:
+            if self._fd is None:
+                self.open()
+
+            # Start a new segment when the current one is full
+            if self.size and self.size + len(line) > self.segment_size:
+                self._fd.close()
+                self.segment += 1
+                self._fd = open(self.segment_file(self.segment), "ab")
+                self.size = 0
+                self._write_index(self.line_count, self.segment, 0)
+
+            elif self.line_count % self.index_every == 0:
+                self._write_index(self.line_count, self.segment, self.size)
+
+            self._fd.write(line)
+            self._fd.flush()
+            self.size += len(line)
+            self.line_count += 1
+
+    def _write_index(self, line, segment, offset):
+        self._index.write(INDEX_ENTRY.pack(line, segment, offset))
+        self._index.flush()
+
+    def close(self):
+        with self.lock:
+            for fd in [self._fd, self._index]:
+                if fd is not None:
+                    fd.close()
+            self._fd = None
+            self._index = None
+
+    # Reading
+
+    def _find_index(self, line):
+        """Binary search the index for the last entry at or before a line.
+        Returns (line, segment, offset), defaulting to the start of the log.
+        """
+        if not os.path.exists(self.index_file):
+            return (0, 0, 0)
+        found = (0, 0, 0)
+        with open(self.index_file, "rb") as fd:
+            low = 0
+            high = os.fstat(fd.fileno()).st_size // INDEX_ENTRY.size
+            while low < high:
+                middle = (low + high) // 2
+                fd.seek(middle * INDEX_ENTRY.size)
+                entry = INDEX_ENTRY.unpack(fd.read(INDEX_ENTRY.size))
+                if entry[0] <= line:
+                    found = entry
+                    low = middle + 1
+                else:
+                    high = middle
+        return found
+
+    def _iter_lines(self, segment, offset):
+        """Yield complete lines starting at a segment and offset, continuing
+        into any later segments. A partially written last line is skipped.
+        """
+        segments = [x for x in self.segments() if x >= segment]
+        for number in segments:
+            with open(self.segment_file(number), "rb") as fd:
+                if number == segment:
+                    fd.seek(offset)
+                for line in fd:
+                    if not line.endswith(b"\n"):
+                        return
+                    yield line
+
+    def count(self):
+        """Count the lines in the log, reading at most index_every lines."""
+        if self._fd is not None:
+            return self.line_count
+        line, segment, offset = self._find_index(2 ** 63)
+        for _ in self._iter_lines(segment, offset):
+            line += 1
+        return line
+
+    def read(self, start=0, count=None):
+        """Return a list of (decoded) lines, starting at line number start."""
+        line, segment, offset = self._find_index(start)
+        lines = []
+        for content in self._iter_lines(segment, offset):
+            if count is not None and len(lines) >= count:
+                break
+            if line >= start:
+                lines.append(content.decode("utf-8", errors="replace"))
+            line += 1
+        return lines
+
+    def tail(self, count=None):
+        """Return the last count lines of the log."""
+        count = count or cfg.LOG_TAIL_LINES
+        return self.read(max(0, self.count() - count), count)
@@ -0,0 +1,46 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from django.core.management.base import BaseCommand
+from snakeface.apps.main.archive import archive_runs
+from snakeface.settings import cfg
+
+
+class Command(BaseCommand):
+    """Move the statuses of finished runs into one compressed archive per
+    run, and delete the rows. Statuses are read and deleted in chunks, so
+    this can run (e.g., from cron) while snakeface is serving.
+
+        python manage.py archive_statuses --days 7
+    """
+
+    help = "Archive the statuses of finished runs (STATUS_ARCHIVE_DAYS)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=float,
+            default=cfg.STATUS_ARCHIVE_DAYS,
+            help="Archive runs that finished more than this many days ago.",
+        )
+        parser.add_argument(
+            "--workflow", type=int, help="Only archive runs of this workflow."
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="The number of statuses to read or delete at once.",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] is None:
+            self.stdout.write("STATUS_ARCHIVE_DAYS is not set, use --days.")
+            return
+        count = archive_runs(
+            workflow=options["workflow"],
+            days=options["days"],
+            chunk_size=options["chunk_size"],
+        )
+        self.stdout.write("Archived statuses for %s runs." % count)
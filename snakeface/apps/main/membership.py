@@ -0,0 +1,67 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from django.db.models.signals import m2m_changed, post_delete
+from snakeface.apps.main.models import Workflow
+from snakeface.cache import MISSING, TTLCache
+from snakeface.settings import cfg
+
+# (workflow id, user id, role) -> bool, invalidated when membership changes
+membership_cache = TTLCache(
+    size=cfg.MEMBERSHIP_CACHE_SIZE, ttl=cfg.MEMBERSHIP_CACHE_SECONDS
+)
+
+# The through model for each role
+ROLES = {
+    "owner": Workflow.owners.through,
+    "contributor": Workflow.contributors.through,
+}
+
+
+def has_role(workflow, user, role):
+    """Determine if a user has a role (owner or contributor) for a workflow,
+    with an exists query on the (indexed) through table instead of loading
+    the related users.
+    """
+    wid = getattr(workflow, "pk", workflow)
+    uid = getattr(user, "pk", user)
+    if not wid or not uid:
+        return False
+
+    key = (wid, uid, role)
+    found = membership_cache.get(key)
+    if found is MISSING:
+        found = ROLES[role].objects.filter(workflow_id=wid, user_id=uid).exists()
+        membership_cache.set(key, found)
+    return found
+
+
+def is_owner(workflow, user):
+    """Owners can run, cancel, edit, delete and send statuses for a workflow"""
+    return has_role(workflow, user, "owner")
+
+
+def is_member(workflow, user):
+    """Members are owners and contributors"""
+    return is_owner(workflow, user) or has_role(workflow, user, "contributor")
+
+
+def invalidate_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached membership for the workflows or users that changed. From
+    the workflow side instance is a workflow, otherwise (e.g.,
+    user.workflow_owners.add) it is a user.
+    """
+    if not action.startswith("post_"):
+        return
+    index = 1 if reverse else 0
+    membership_cache.delete_matching(lambda key, value: key[index] == instance.pk)
+
+
+def invalidate_workflow(sender, instance, **kwargs):
+    membership_cache.delete_matching(lambda key, value: key[0] == instance.pk)
+
+
+for through in ROLES.values():
+    m2m_changed.connect(invalidate_membership, sender=through)
+post_delete.connect(invalidate_workflow, sender=Workflow)
@@ -2,21 +2,29 @@ __author__ = "Vanessa Sochat"
 __copyright__ = "Copyright 2020-2021, Vanessa Sochat"
 __license__ = "MPL 2.0"
 
-from django.db.models.signals import pre_save
-from django.db import models
+from django.db.models.signals import pre_save, post_delete
+from django.db import connection, models, transaction
 
 from django.conf import settings
 from django.urls import reverse
+from django.utils.dateparse import parse_datetime
 from django.contrib.postgres.fields import JSONField as DjangoJSONField
 
 from snakeface.apps.main.utils import CommandRunner, write_file, get_tmpfile, read_file
+from snakeface.apps.main.archive import read_archive
+from snakeface.apps.main.events import workflow_events
+from snakeface.apps.main.logs import RunLog
+from snakeface.apps.main.telemetry import load_samples
 from snakeface.argparser import SnakefaceParser
 from snakeface.settings import cfg
 from django.db.models import Field
 
-import itertools
+import datetime
 import json
 import os
+import re
+import shutil
+import time
 
 
 PRIVACY_CHOICES = (
@@ -61,6 +69,7 @@ RUNNING_CHOICES = [
     ("RUNNING", "RUNNING"),
     ("NOTRUNNING", "NOTRUNNING"),
     ("CANCELLED", "CANCELLED"),
+    ("QUEUED", "QUEUED"),
 ]
 
 
@@ -73,19 +82,25 @@ class Workflow(models.Model):
     command = models.TextField(blank=False, null=False)
     data = JSONField(blank=False, null=False, default="{}")
     dag = models.TextField(blank=True, null=True)
-    error = models.TextField(blank=True, null=True)
-    output = models.TextField(blank=True, null=True)
     modify_date = models.DateTimeField("date modified", auto_now=True)
     name = models.CharField(max_length=250, unique=True, blank=True, null=True)
     snakefile = models.TextField(blank=False, null=False, max_length=250)
     snakemake_id = models.TextField(blank=False, null=False)
-    status = models.TextField(
-        choices=RUNNING_CHOICES, default="NOTRUNNING", blank=False, null=False
-    )
-    thread = models.PositiveIntegerField(default=None, blank=True, null=True)
-    retval = models.PositiveIntegerField(default=None, blank=True, null=True)
     workdir = models.TextField(blank=False, null=False, max_length=250)
 
+    # Run queue, higher priority runs are started first (after fair share)
+    priority = models.IntegerField(default=0)
+
+    # The latest run, older runs are kept as history
+    current_run = models.ForeignKey(
+        "main.WorkflowRun",
+        blank=True,
+        null=True,
+        default=None,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+
     owners = models.ManyToManyField(
         "users.User",
         blank=True,
@@ -114,16 +129,39 @@ class Workflow(models.Model):
     )
 
     @property
-    def message_fields(self):
-        fields = set()
-        for status in self.workflowstatus_set.all():
-            [fields.add(x) for x in status.msg]
-        return fields
-
-    def has_view_permission(self):
-        if cfg.NOTEBOOK or cfg.NOTEBOOK_ONLY:
-            return True
-        return (self.private and self.request.user in self.members) or not self.private
+    def status(self):
+        """The status of the current run"""
+        if self.current_run:
+            return self.current_run.status
+        return "NOTRUNNING"
+
+    def get_statuses(self):
+        """Return statuses for the current run in the database, or statuses
+        that were saved without a run (e.g., before runs were kept).
+        """
+        if self.current_run_id:
+            return self.current_run.get_statuses()
+        return self.workflowstatus_set.filter(run=None)
+
+    def iter_statuses(self, since=None, fields=None):
+        """Yield all statuses for the current run, archived ones first, or
+        only the ones after the status id since. If fields are given, only
+        they are loaded from the database.
+        """
+        if self.current_run_id:
+            return self.current_run.iter_statuses(since, fields)
+        statuses = self.get_statuses()
+        if since is not None:
+            statuses = statuses.filter(id__gt=since)
+        if fields:
+            statuses = statuses.only(*fields)
+        return statuses.order_by("id").iterator()
+
+    def count_statuses(self, until):
+        """Count the statuses for the current run up to the status id until"""
+        if self.current_run_id:
+            return self.current_run.count_statuses(until)
+        return self.get_statuses().filter(id__lte=until).count()
 
     def update_command(self, command=None, do_save=False):
         """Given a command (or an automated save from the signal) update
@@ -169,23 +207,29 @@ class Workflow(models.Model):
     def get_label(self):
         return "workflow"
 
-    @property
-    def members(self):
-        return list(itertools.chain(self.owners.all(), self.contributors.all()))
-
     def get_report(self):
         """load the report file, if it exists."""
         report_file = self._get_report_file()
         if report_file:
             return read_file(report_file)
 
-    def reset(self):
-        """Empty all run related fields to prepare for a new run."""
-        self.output = None
-        self.error = None
-        self.retval = None
-        self.workflowstatus_set.all().delete()
-        self.save()
+    def new_run(self, user=None, status="NOTRUNNING"):
+        """Start a new run for the workflow. Previous runs (and their statuses
+        and logs) are kept as history, so this doesn't need to delete anything.
+        """
+        run = WorkflowRun.objects.create(
+            workflow=self,
+            user=user,
+            status=status,
+            command=self.command,
+            priority=self.priority,
+        )
+
+        # An update avoids the pre_save signal (and updating the dag)
+        Workflow.objects.filter(pk=self.pk).update(current_run=run)
+        self.current_run = run
+        workflow_events.send(self.pk)
+        return run
 
     def has_report(self):
         """returns True if the workflow command has a designated report, and
@@ -202,32 +246,330 @@ class Workflow(models.Model):
             fullpath = os.path.join(self.workdir, report_file)
         return fullpath
 
-    def has_edit_permission(self):
-        """If we are running in a notebook environment, there is just one user
-        that has edit access to anything. Otherwise, the user must be an owner
+    class Meta:
+        app_label = "main"
+
+
+class WorkflowRun(models.Model):
+    """A workflow run is one execution of a workflow, and holds the statuses,
+    output, return value, timing and resource usage for it.
+    """
+
+    add_date = models.DateTimeField("date queued", auto_now_add=True)
+    start_date = models.DateTimeField("date started", blank=True, null=True)
+    end_date = models.DateTimeField("date finished", blank=True, null=True)
+    command = models.TextField(blank=True, null=True)
+    status = models.TextField(
+        choices=RUNNING_CHOICES, default="NOTRUNNING", blank=False, null=False
+    )
+    priority = models.IntegerField(default=0)
+    thread = models.PositiveIntegerField(default=None, blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    output = models.TextField(blank=True, null=True)
+    retval = models.IntegerField(default=None, blank=True, null=True)
+
+    # The last sequence number added by a monitor client (see IngestConsumer)
+    last_seq = models.PositiveIntegerField(default=0)
+
+    # Statuses up to this id were moved to the run archive (see archive.py)
+    archived_id = models.PositiveIntegerField(default=0)
+
+    # The run supervisor process, to find the run again after a restart
+    pid = models.PositiveIntegerField(default=None, blank=True, null=True)
+    host = models.CharField(max_length=250, blank=True, null=True)
+
+    # Resource usage (cpu seconds, max rss in KB, wall seconds) and samples
+    cpu_time = models.FloatField(default=None, blank=True, null=True)
+    max_rss = models.PositiveIntegerField(default=None, blank=True, null=True)
+    wall_time = models.FloatField(default=None, blank=True, null=True)
+    telemetry = JSONField(blank=True, null=True, default=None)
+
+    workflow = models.ForeignKey(
+        "main.Workflow", null=False, blank=False, on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        "users.User",
+        blank=True,
+        null=True,
+        default=None,
+        on_delete=models.SET_NULL,
+        related_name="workflow_runs",
+    )
+
+    def __str__(self):
+        return "[workflow-run:%s:%s]" % (self.workflow_id, self.id)
+
+    def get_label(self):
+        return "workflow_run"
+
+    @property
+    def logs_dir(self):
+        return os.path.join(cfg.LOGS_DIRECTORY, str(self.workflow_id), str(self.id))
+
+    def get_log(self, stream="stdout"):
+        """Return the run log for a stream (stdout or stderr)"""
+        return RunLog(self.logs_dir, stream)
+
+    def get_log_tail(self, stream="stdout"):
+        """Return the tail of a run log as html, falling back to the output
+        or error saved on the run.
         """
-        if cfg.NOTEBOOK or cfg.NOTEBOOK_ONLY:
-            return True
-        return (
-            not self.request.user.is_anonymous
-            and self.request.user in self.members
-            and self.private
-        )
+        lines = self.get_log(stream).tail()
+        if not lines:
+            return self.output if stream == "stdout" else self.error
+        return "<br>".join(lines)
+
+    @property
+    def output_tail(self):
+        return self.get_log_tail("stdout")
+
+    @property
+    def error_tail(self):
+        return self.get_log_tail("stderr")
+
+    @property
+    def telemetry_file(self):
+        return os.path.join(self.logs_dir, "telemetry.jsonl")
+
+    def get_telemetry(self):
+        """Return resource samples for the run, live from the telemetry file
+        while running, and otherwise from the series saved at the end.
+        """
+        if self.status == "RUNNING" or not self.telemetry:
+            return load_samples(self.telemetry_file)
+        return self.telemetry
+
+    def get_statuses(self):
+        """Statuses for the run that are in the database (not archived)"""
+        return self.workflowstatus_set.filter(id__gt=self.archived_id)
+
+    def iter_statuses(self, since=None, fields=None):
+        """Yield the statuses in the run archive (read lazily), and then the
+        ones in the database, optionally only after the status id since. The
+        archive is only read if it has statuses after since. If fields are
+        given, only they are loaded from the database.
+        """
+        since = since or 0
+        if since < self.archived_id:
+            for status in read_archive(self):
+                if status.id > since:
+                    yield status
+        statuses = self.get_statuses().filter(id__gt=since)
+        if fields:
+            statuses = statuses.only(*fields)
+        yield from statuses.order_by("id").iterator()
+
+    def count_statuses(self, until):
+        """Count the statuses up to the status id until"""
+        count = self.get_statuses().filter(id__lte=until).count()
+        if self.archived_id:
+            count += sum(1 for x in read_archive(self) if x.id <= until)
+        return count
+
+    def delete_logs(self):
+        if os.path.exists(self.logs_dir):
+            shutil.rmtree(self.logs_dir)
 
     class Meta:
         app_label = "main"
+        ordering = ["-id"]
+
+
+# Message keys that are extracted into WorkflowStatus columns (key, column)
+MESSAGE_COLUMNS = [
+    ("level", "level"),
+    ("jobid", "job"),
+    ("rule", "rule"),
+    ("timestamp", "timestamp"),
+    ("msg", "text"),
+]
+
+
+# Status levels and the class of their badge (others are secondary)
+STATUS_LEVELS = {
+    "debug": "primary",
+    "dag_debug": "primary",
+    "info": "info",
+    "warning": "warning",
+    "error": "danger",
+}
+
+# Display fields of a WorkflowStatus, computed with the columns
+DISPLAY_COLUMNS = ["level_class", "traceback", "html"]
+
+TRACEBACK_REGEX = re.compile("traceback|exception", re.IGNORECASE)
+
+
+def get_display_fields(level, text):
+    """How a status is shown, computed once when it's created: the badge
+    class for the level, and if the message is a traceback, which is shown
+    as code (html is only set then, otherwise the text is shown).
+    """
+    traceback = bool(text and TRACEBACK_REGEX.search(text))
+    return {
+        "level_class": STATUS_LEVELS.get(level, "secondary"),
+        "traceback": traceback,
+        "html": "<code>%s</code>" % text.replace("\n", "<br>") if traceback else None,
+    }
+
+
+def parse_timestamp(value):
+    """Parse a message timestamp, seconds since the epoch (the snakemake
+    monitor), an iso date, or time.asctime(). Returns None if it isn't one.
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        try:
+            return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    if not isinstance(value, str):
+        return None
+    try:
+        return parse_timestamp(float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    if parsed is not None:
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed
+
+    # time.asctime() is in local time
+    try:
+        return parse_timestamp(time.mktime(time.strptime(value)))
+    except (OverflowError, ValueError):
+        return None
+
+
+def get_message(status):
+    """The whole message of a status (or a historical model of one, in a
+    migration), the extracted columns with the remaining json
+    """
+    if not isinstance(status.msg, dict):
+        return status.msg
+    message = {}
+    if status.level is not None:
+        message["level"] = status.level
+    if status.job is not None:
+        message["jobid"] = status.job
+    if status.rule is not None:
+        message["rule"] = status.rule
+    if status.timestamp is not None:
+        message["timestamp"] = status.timestamp.timestamp()
+    if status.text is not None:
+        message["msg"] = status.text
+    message.update(status.msg)
+    return message
+
+
+def extract_message(msg):
+    """Split a status message into values for the WorkflowStatus columns,
+    and the remaining keys for the json. A key is only removed from the json
+    when the column holds it exactly (e.g., a string level, or an integer job
+    id), otherwise the column is still set if it can be, and the key stays.
+    """
+    fields = {column: None for _, column in MESSAGE_COLUMNS}
+    if not isinstance(msg, dict):
+        fields.update(get_display_fields(None, None))
+        return fields, msg
+    msg = dict(msg)
+
+    if isinstance(msg.get("level"), str):
+        fields["level"] = msg.pop("level")[:50]
+    if isinstance(msg.get("msg"), str):
+        fields["text"] = msg.pop("msg")
+
+    jobid = msg.get("jobid")
+    if isinstance(jobid, int) and not isinstance(jobid, bool):
+        fields["job"] = msg.pop("jobid")
+
+    # A job's rule is its name, e.g., for job_info
+    if isinstance(msg.get("rule"), str) and len(msg["rule"]) <= 250:
+        fields["rule"] = msg.pop("rule")
+    elif isinstance(msg.get("name"), str):
+        fields["rule"] = msg["name"][:250]
+
+    timestamp = msg.get("timestamp")
+    fields["timestamp"] = parse_timestamp(timestamp)
+    if fields["timestamp"] and isinstance(timestamp, (int, float)):
+        del msg["timestamp"]
+    fields.update(get_display_fields(fields["level"], fields["text"]))
+    return fields, msg
 
 
 class WorkflowStatus(models.Model):
-    """A workflow status is a status message send from running a workflow"""
+    """A workflow status is a status message send from running a workflow.
+    The fields that statuses are filtered and shown by are extracted into
+    columns when a status is created (see from_message), along with how
+    the status is shown, and the rest of the message is kept as json.
+    """
 
     # executor = models.TextField(null=False, blank=False)
     add_date = models.DateTimeField("date published", auto_now_add=True)
     modify_date = models.DateTimeField("date modified", auto_now=True)
     msg = JSONField(blank=False, null=False, default="{}")
+    level = models.CharField(max_length=50, null=True, blank=True)
+    job = models.IntegerField(null=True, blank=True)
+    rule = models.CharField(max_length=250, null=True, blank=True)
+    timestamp = models.DateTimeField(null=True, blank=True)
+    text = models.TextField(null=True, blank=True)
+
+    # Display fields (see get_display_fields)
+    level_class = models.CharField(max_length=20, null=True, blank=True)
+    traceback = models.BooleanField(default=False)
+    html = models.TextField(null=True, blank=True)
+
     workflow = models.ForeignKey(
         "main.Workflow", null=False, blank=False, on_delete=models.CASCADE
     )
+    run = models.ForeignKey(
+        "main.WorkflowRun", null=True, blank=True, on_delete=models.CASCADE
+    )
+
+    @classmethod
+    def from_message(cls, msg, **kwargs):
+        """Create an (unsaved) status for a message, with the extracted
+        fields. Use this instead of WorkflowStatus(msg=...), bulk_create
+        doesn't call save.
+        """
+        fields, msg = extract_message(msg)
+        kwargs.update(fields)
+        return cls(msg=msg, **kwargs)
+
+    @classmethod
+    def add_batch(cls, statuses, batch_size=500):
+        """Add (unsaved) statuses in one transaction. The rows of their
+        workflows are locked first (in order, so batches can't deadlock), so
+        the statuses of a workflow get their ids in the order they commit,
+        and a client that has the statuses up to an id can't miss one that
+        commits later with a lower id (see get_status_update). SQLite writes
+        one transaction at a time, and can't lock rows.
+        """
+        ids = sorted(set(status.workflow_id for status in statuses))
+        with transaction.atomic():
+            if connection.features.has_select_for_update:
+                locked = Workflow.objects.select_for_update().filter(id__in=ids)
+                list(locked.order_by("id").values_list("id", flat=True))
+            cls.objects.bulk_create(statuses, batch_size=batch_size)
+
+    @property
+    def message(self):
+        """The whole message, the extracted columns with the remaining json"""
+        return get_message(self)
+
+    class Meta:
+        app_label = "main"
+        indexes = [
+            models.Index(fields=["workflow", "level"], name="status_workflow_level"),
+            models.Index(fields=["workflow", "job"], name="status_workflow_job"),
+            models.Index(fields=["run", "level"], name="status_run_level"),
+            models.Index(fields=["run", "job"], name="status_run_job"),
+        ]
 
 
 def update_workflow(sender, instance, **kwargs):
@@ -235,4 +577,9 @@ def update_workflow(sender, instance, **kwargs):
     instance.update_command()
 
 
+def delete_run_logs(sender, instance, **kwargs):
+    instance.delete_logs()
+
+
 pre_save.connect(update_workflow, sender=Workflow)
+post_delete.connect(delete_run_logs, sender=WorkflowRun)
@@ -1,4 +1,4 @@
-from django.urls import re_path
+from django.urls import path, re_path
 
 from . import consumers
 
@@ -8,6 +8,20 @@ websocket_urlpatterns = [
         consumers.WorkflowConsumer.as_asgi(),
         name="workflow_status_websocket",
     ),
+    re_path(
+        r"ws/ingest/workflows/(?P<wid>\d+)/$",
+        consumers.IngestConsumer.as_asgi(),
+        name="workflow_ingest_websocket",
+    ),
+]
+
+# Served before the Django application (see asgi.py)
+http_urlpatterns = [
+    path(
+        "stream_workflow_statuses",
+        consumers.StreamIngestConsumer.as_asgi(),
+        name="stream_workflow_statuses",
+    ),
 ]
 
 app_name = "main"
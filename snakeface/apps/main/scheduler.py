@@ -0,0 +1,192 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+from snakeface.apps.main.models import WorkflowRun
+from django.utils import timezone
+
+import threading
+import time
+
+
+class RunQueue(object):
+    """Admission control for workflow runs. A run that is over the user or
+    global limit is queued instead of rejected, and queued runs are started
+    as running ones finish. Running and queued runs are kept in memory and
+    re-synced from the database at most every QUEUE_SYNC_SECONDS (or when a
+    run finishes), so admission doesn't count Workflow rows on each request.
+
+    Queued runs are ordered by fair share: users with fewer running workflows
+    go first, then by the workflow priority (higher first), then the time
+    the run was queued.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.running = {}
+        self.queued = {}
+        self.synced = None
+
+    def __str__(self):
+        return "[run-queue:%s running:%s queued]" % (
+            len(self.running),
+            len(self.queued),
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def running_notebook(self):
+        return cfg.NOTEBOOK or cfg.NOTEBOOK_ONLY
+
+    @property
+    def global_limit(self):
+        if self.running_notebook:
+            return cfg.MAXIMUM_NOTEBOOK_JOBS
+        return cfg.USER_WORKFLOW_GLOBAL_RUNS_LIMIT
+
+    @property
+    def user_limit(self):
+        if self.running_notebook:
+            return None
+        return cfg.USER_WORKFLOW_RUNS_LIMIT
+
+    def sync(self, force=False):
+        """Load running and queued runs from the database, unless we've done
+        so within the last QUEUE_SYNC_SECONDS.
+        """
+        with self.lock:
+            if (
+                not force
+                and self.synced
+                and time.time() - self.synced < cfg.QUEUE_SYNC_SECONDS
+            ):
+                return
+            self.running = dict(
+                WorkflowRun.objects.filter(status="RUNNING").values_list("id", "user")
+            )
+            self.queued = {
+                rid: (priority, queued_at, uid)
+                for rid, priority, queued_at, uid in WorkflowRun.objects.filter(
+                    status="QUEUED"
+                ).values_list("id", "priority", "add_date", "user")
+            }
+            self.synced = time.time()
+
+    def user_running(self, uid):
+        return sum(1 for x in self.running.values() if x == uid)
+
+    def has_slot(self, uid):
+        """Determine if a run for a user can start without going over limits"""
+        if self.global_limit and len(self.running) >= self.global_limit:
+            return False
+        if self.user_limit and self.user_running(uid) >= self.user_limit:
+            return False
+        return True
+
+    def ordered(self):
+        """Return queued run ids in the order they should be started"""
+        counts = {}
+        for uid in self.running.values():
+            counts[uid] = counts.get(uid, 0) + 1
+
+        def sort_key(rid):
+            priority, queued_at, uid = self.queued[rid]
+            return (counts.get(uid, 0), -priority, queued_at)
+
+        return sorted(self.queued, key=sort_key)
+
+    def submit(self, workflow, user):
+        """Queue a new run for a workflow, and start it right away if there is
+        a free slot. Returns the run, which is RUNNING if it was started.
+        """
+        with self.lock:
+            self.sync()
+            run = workflow.new_run(user=user, status="QUEUED")
+            self.queued[run.id] = (run.priority, run.add_date, user.id)
+            self.dispatch()
+            if run.id in self.running:
+                run.status = "RUNNING"
+            return run
+
+    def remove(self, rid):
+        """Remove a run from the queue (e.g., when it is cancelled)"""
+        with self.lock:
+            self.queued.pop(rid, None)
+
+    def finished(self, rid):
+        """Called when a run finishes, frees the slot and starts queued runs.
+        We sync first, as the run may have finished in a worker process.
+        """
+        with self.lock:
+            self.sync(force=True)
+            self.running.pop(rid, None)
+            self.dispatch()
+
+    def dispatch(self):
+        """Start queued runs, in order, while there are free slots"""
+        from snakeface.apps.main.tasks import start_run
+
+        with self.lock:
+            self.sync()
+            started = True
+            while started:
+                started = False
+                for rid in self.ordered():
+                    uid = self.queued[rid][2]
+                    if not self.has_slot(uid):
+                        continue
+
+                    # Claiming the run in the database prevents another
+                    # process from starting it too
+                    del self.queued[rid]
+                    if not WorkflowRun.objects.filter(pk=rid, status="QUEUED").update(
+                        status="RUNNING"
+                    ):
+                        continue
+                    self.running[rid] = uid
+                    start_run(WorkflowRun.objects.get(pk=rid))
+                    started = True
+                    break
+
+    def get_queue(self):
+        """Return the queued runs in order, with position and seconds waited"""
+        with self.lock:
+            self.sync()
+            now = timezone.now()
+            queue = []
+            workflows = dict(
+                WorkflowRun.objects.filter(id__in=self.queued).values_list(
+                    "id", "workflow"
+                )
+            )
+            for position, rid in enumerate(self.ordered()):
+                priority, queued_at, uid = self.queued[rid]
+                queue.append(
+                    {
+                        "id": workflows.get(rid),
+                        "run": rid,
+                        "position": position + 1,
+                        "priority": priority,
+                        "user": uid,
+                        "waiting": (now - queued_at).total_seconds(),
+                    }
+                )
+            return queue
+
+    def get_position(self, rid):
+        """Return the (1-based) queue position and seconds waited for a
+        run, or None if it isn't queued.
+        """
+        with self.lock:
+            self.sync()
+            if rid not in self.queued:
+                return None
+            position = self.ordered().index(rid) + 1
+            waiting = (timezone.now() - self.queued[rid][1]).total_seconds()
+            return {"position": position, "waiting": waiting}
+
+
+run_queue = RunQueue()
@@ -0,0 +1,265 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+from snakeface.apps.main.models import Workflow
+from snakeface.apps.main.tasks import STATUS_FIELDS, serialize_status
+from asgiref.sync import sync_to_async
+from django.db.models import Max
+
+import asyncio
+import collections
+import json
+import uuid
+
+# The version of the workflow update protocol that frames are sent with
+PROTOCOL_VERSION = 2
+
+# The run logs sent in frames
+LOGS = {"output": "stdout", "error": "stderr"}
+
+# At most this many new statuses are sent in a frame, with more the page
+# loads its table page again
+FRAME_STATUSES = 200
+
+
+def read_lines(log, start, end):
+    """Return the first line number and lines start to end of a run log, at
+    most LOG_TAIL_LINES (the last ones)
+    """
+    start = max(start, end - cfg.LOG_TAIL_LINES)
+    return start, log.read(start, end - start) if end > start else []
+
+
+def get_cursor(workflow, run_id=None):
+    """Where the updates of a workflow are: its run, the last status id, the
+    number of lines in each run log (and where the logs end on disk, to only
+    count lines when they change), and the run status and return value.
+    With a run id, it's the start of that run instead.
+    """
+    run = workflow.current_run
+    cursor = {"run": workflow.current_run_id, "last_id": 0}
+    cursor.update({"status": None, "retval": None})
+    for name, stream in LOGS.items():
+        cursor[name] = 0
+        cursor[stream] = None
+    if run and run_id is None:
+        cursor.update({"status": run.status, "retval": run.retval})
+        cursor["last_id"] = max(
+            run.archived_id,
+            run.get_statuses().aggregate(last_id=Max("id"))["last_id"] or 0,
+        )
+        for name, stream in LOGS.items():
+            log = run.get_log(stream)
+            cursor[stream] = log.position()
+            cursor[name] = log.count()
+    return cursor
+
+
+def get_changes(workflow_id, cursor):
+    """Return the changes to a workflow after a cursor, or None if nothing
+    changed, and the new cursor. If the current run isn't the run of the
+    cursor, the changes are from the start of the current run (a reset).
+    Without a cursor, it's the current state and there are no changes.
+    New statuses are sent as rows of the status table, with the status id
+    they come after (since), for the page to add the ones it shows. With
+    more than FRAME_STATUSES, changes only say that there are new ones.
+    Raises Workflow.DoesNotExist if the workflow was deleted.
+    """
+    workflow = Workflow.objects.select_related("current_run").get(id=workflow_id)
+    if cursor is None:
+        return None, get_cursor(workflow)
+
+    run = workflow.current_run
+    reset = cursor["run"] != workflow.current_run_id
+    cursor = get_cursor(workflow, run_id=run.id if run else None) if reset else cursor
+    cursor = dict(cursor)
+    changes = {"reset": reset, "changed": False}
+    if not run:
+        return (changes if reset else None), cursor
+
+    new = run.get_statuses().filter(id__gt=cursor["last_id"])
+    statuses = list(new.only(*STATUS_FIELDS).order_by("id")[: FRAME_STATUSES + 1])
+    if len(statuses) > FRAME_STATUSES:
+        changes["changed"] = True
+        cursor["last_id"] = new.aggregate(last_id=Max("id"))["last_id"]
+    elif statuses:
+        changes["changed"] = True
+        changes["since"] = cursor["last_id"]
+        changes["statuses"] = [serialize_status(x, x.id) for x in statuses]
+        cursor["last_id"] = statuses[-1].id
+
+    # Logs are only counted if they grew on disk
+    for name, stream in LOGS.items():
+        log = run.get_log(stream)
+        position = log.position()
+        if position == cursor[stream]:
+            continue
+        cursor[stream] = position
+        count = log.count()
+        if count > cursor[name]:
+            start, lines = read_lines(log, cursor[name], count)
+            changes[name] = {"start": start, "lines": lines}
+            cursor[name] = count
+
+    changed = run.status != cursor["status"] or run.retval != cursor["retval"]
+    cursor.update({"status": run.status, "retval": run.retval})
+    logs = any(name in changes for name in LOGS)
+    if not (reset or changed or logs or changes["changed"]):
+        return None, cursor
+    return changes, cursor
+
+
+def get_snapshot(workflow_id, cursor):
+    """The state of a workflow at a cursor, for a client that has nothing
+    (or too old) to update: the run, and the tails of its logs. The client
+    loads the status table again if it doesn't have the last status id.
+    """
+    workflow = Workflow.objects.select_related("current_run").get(id=workflow_id)
+    run = workflow.current_run
+    snapshot = {"reset": True, "changed": False}
+    if not run or run.id != cursor["run"]:
+        return snapshot
+    for name, stream in LOGS.items():
+        start, lines = read_lines(run.get_log(stream), 0, cursor[name])
+
+        # Runs from before logs were kept have the tail saved
+        saved = run.output if stream == "stdout" else run.error
+        if not lines and saved:
+            start, lines = 0, saved.split("<br>")
+        snapshot[name] = {"start": start, "lines": lines}
+    return snapshot
+
+
+async_get_changes = sync_to_async(get_changes, thread_sensitive=True)
+async_get_snapshot = sync_to_async(get_snapshot, thread_sensitive=True)
+
+
+class WorkflowStream(object):
+    """The updates of one workflow, as frames shared by the sockets viewing
+    it (see WorkflowConsumer). When there is an event for the workflow, the
+    changes since the last frame (new statuses, and lines appended to the
+    run output and error) are read once, and sent to every socket as a frame
+    with the next sequence number. The last WORKFLOW_STREAM_FRAMES frames
+    are kept, so a client that reconnects with the stream id and the last
+    sequence number it has gets only the frames it missed. Otherwise (or if
+    the stream is from another process, or was dropped) it gets a snapshot.
+    """
+
+    def __init__(self, workflow_id):
+        self.workflow_id = workflow_id
+        self.id = uuid.uuid4().hex[:16]
+        self.seq = 0
+        self.cursor = None
+        self.frames = collections.deque(maxlen=cfg.WORKFLOW_STREAM_FRAMES)
+        self.sockets = set()
+        self.lock = asyncio.Lock()
+        self.scheduled = None
+
+    def __str__(self):
+        return "[workflow-stream:%s:%s]" % (self.workflow_id, self.seq)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_frame(self, data, seq):
+        frame = {"v": PROTOCOL_VERSION, "stream": self.id, "seq": seq}
+        frame.update(data)
+        frame.update(
+            {
+                "run": self.cursor["run"],
+                "last_id": self.cursor["last_id"],
+                "status": self.cursor["status"],
+                "retval": self.cursor["retval"],
+            }
+        )
+        return json.dumps(frame)
+
+    async def update(self):
+        """Add a frame with the changes since the last one (if any), and
+        send new frames to the sockets
+        """
+        async with self.lock:
+            try:
+                changes, self.cursor = await async_get_changes(
+                    self.workflow_id, self.cursor
+                )
+            except Workflow.DoesNotExist:
+                for socket in list(self.sockets):
+                    await socket.close_missing()
+                return
+            if changes:
+                self.seq += 1
+                self.frames.append((self.seq, self.get_frame(changes, self.seq)))
+        for socket in list(self.sockets):
+            await socket.send_frames()
+
+    def schedule(self):
+        """Update after WORKFLOW_PUSH_MS, unless an update is waiting"""
+        if not self.scheduled:
+            self.scheduled = asyncio.create_task(self.send_scheduled())
+
+    async def send_scheduled(self):
+        await asyncio.sleep(cfg.WORKFLOW_PUSH_MS / 1000)
+
+        # Events from now on need another update
+        self.scheduled = None
+        if self.sockets:
+            await self.update()
+
+    def frames_after(self, seq):
+        """The frames after a sequence number, or None if some are gone"""
+        if seq > self.seq:
+            return None
+        first = self.frames[0][0] if self.frames else self.seq + 1
+        if seq < first - 1:
+            return None
+        return [frame for number, frame in self.frames if number > seq]
+
+    async def snapshot(self):
+        """The last sequence number, and a frame with the state there"""
+        async with self.lock:
+            data = await async_get_snapshot(self.workflow_id, self.cursor)
+            return self.seq, self.get_frame(data, self.seq)
+
+
+class WorkflowStreams(object):
+    """The workflow streams of this process. A stream is kept while sockets
+    view its workflow, and the last max_idle streams without sockets are
+    kept so that clients can resume, but aren't updated.
+    """
+
+    max_idle = 100
+
+    def __init__(self):
+        self.streams = collections.OrderedDict()
+
+    def __str__(self):
+        return "[workflow-streams:%s]" % len(self.streams)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def subscribe(self, workflow_id, socket):
+        stream = self.streams.pop(workflow_id, None) or WorkflowStream(workflow_id)
+        self.streams[workflow_id] = stream
+        stream.sockets.add(socket)
+        return stream
+
+    def unsubscribe(self, workflow_id, socket):
+        stream = self.streams.get(workflow_id)
+        if not stream:
+            return
+        stream.sockets.discard(socket)
+        if not stream.sockets:
+            self.streams.move_to_end(workflow_id)
+            if stream.scheduled:
+                stream.scheduled.cancel()
+                stream.scheduled = None
+        idle = [wid for wid, x in self.streams.items() if not x.sockets]
+        for wid in idle[: max(0, len(idle) - self.max_idle)]:
+            del self.streams[wid]
+
+
+workflow_streams = WorkflowStreams()
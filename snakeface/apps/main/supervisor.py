@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+# The supervisor runs a workflow command on behalf of the web server. It is
+# started in its own session, so it outlives a restart of the web server, and
+# it captures output to the run logs and writes the exit status of the
+# command to status.json in the run logs directory when it finishes. Usage:
+#
+#   python supervisor.py <logs directory> -- <command>
+
+import fcntl
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Written in the run logs directory when the supervisor starts
+INFO_FILE = "supervisor.json"
+
+# Written in the run logs directory when the command finishes
+STATUS_FILE = "status.json"
+
+# Locked by the server process that waits on the run, while it does
+WAIT_LOCK = "wait.lock"
+
+# Output of the supervisor itself (e.g., if it fails to start the command)
+SUPERVISOR_LOG = "supervisor.log"
+
+
+def read_json(filename):
+    try:
+        with open(filename, "r") as fd:
+            return json.loads(fd.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(filename, content):
+    """Write json atomically, so a reader never sees a partial file"""
+    tmpfile = "%s.tmp" % filename
+    with open(tmpfile, "w") as fd:
+        fd.write(json.dumps(content))
+    os.rename(tmpfile, filename)
+
+
+def read_status(root):
+    """Return the exit status written by the supervisor, or None if the
+    command has not finished (or the supervisor was killed).
+    """
+    return read_json(os.path.join(root, STATUS_FILE))
+
+
+def write_status(root, status):
+    write_json(os.path.join(root, STATUS_FILE), status)
+
+
+def lock_file(filename):
+    """Take an exclusive lock on a file, without blocking. Returns the open
+    lock file, which holds the lock until it's closed or the process exits,
+    or None if another process has it.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    fd = open(filename, "a")
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return None
+    return fd
+
+
+def lock_wait(root):
+    """Take the lock for waiting on (and finishing) the run in a logs
+    directory, see lock_file
+    """
+    return lock_file(os.path.join(root, WAIT_LOCK))
+
+
+def read_info(root):
+    """Return the pid, parent pid, host and start time of the supervisor"""
+    return read_json(os.path.join(root, INFO_FILE))
+
+
+def get_hostname():
+    return socket.gethostname()
+
+
+def get_parent(pid):
+    """Return the parent pid of a process, or None if it can't be read"""
+    from snakeface.apps.main.telemetry import read_proc_stat
+
+    try:
+        return int(read_proc_stat(pid)[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def get_process_start(pid):
+    """Return the start time (seconds since the epoch) of a process, or None
+    if it doesn't exist. Together with the pid this identifies a process,
+    since pids are reused.
+    """
+    from snakeface.apps.main.telemetry import CLOCK_TICKS, read_proc_stat
+
+    try:
+        ticks = int(read_proc_stat(pid)[19])
+        with open("/proc/stat", "r") as fd:
+            for line in fd:
+                if line.startswith("btime "):
+                    return int(line.split()[1]) + ticks / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        pass
+
+    # Without /proc we can only tell that the pid exists
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return time.time()
+
+
+def supervise(root, cmd):
+    """Run a command, streaming output to the run logs, and write its exit
+    status and resource usage when it finishes. Returns the return code.
+    """
+    from snakeface.apps.main.logs import RunLog
+    from snakeface.apps.main.utils import get_returncode
+    import subprocess
+
+    # A cancel signals the whole process group: we keep waiting so that the
+    # exit status of the command is still written. A handler (instead of
+    # ignoring the signal) is reset for the command when it is started.
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, lambda *args: None)
+
+    logs = {"stdout": RunLog(root, "stdout"), "stderr": RunLog(root, "stderr")}
+    start = time.time()
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        logs["stderr"].append(str(e))
+        logs["stderr"].close()
+        write_status(root, {"retval": 127, "wall_time": 0, "end": time.time()})
+        return 127
+
+    def reader(stream, log):
+        for line in iter(stream.readline, b""):
+            log.append(line)
+        stream.close()
+
+    readers = [
+        threading.Thread(target=reader, args=(p.stdout, logs["stdout"])),
+        threading.Thread(target=reader, args=(p.stderr, logs["stderr"])),
+    ]
+    [t.start() for t in readers]
+
+    while True:
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    [t.join() for t in readers]
+    [log.close() for log in logs.values()]
+
+    retval = get_returncode(status)
+    write_status(
+        root,
+        {
+            "retval": retval,
+            "cpu_time": rusage.ru_utime + rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss,
+            "wall_time": time.time() - start,
+            "end": time.time(),
+        },
+    )
+    return retval
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 3 or argv[1] != "--":
+        sys.exit("Usage: supervisor.py <logs directory> -- <command>")
+    root, cmd = argv[0], argv[2:]
+    os.makedirs(root, exist_ok=True)
+
+    # Written first, while the process that started us is still our parent
+    write_json(
+        os.path.join(root, INFO_FILE),
+        {
+            "pid": os.getpid(),
+            "parent": os.getppid(),
+            "host": get_hostname(),
+            "start": time.time(),
+        },
+    )
+    retval = supervise(root, cmd)
+    sys.exit(retval if retval >= 0 else 128 - retval)
+
+
+if __name__ == "__main__":
+    # Run as a script, the snakeface package might not be installed. The
+    # directory of the script is replaced so modules here don't shadow others.
+    sys.path[0] = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    )
+    main()
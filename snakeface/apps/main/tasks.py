@@ -5,11 +5,29 @@ __license__ = "MPL 2.0"
 from snakeface.settings import cfg
 from django.contrib import messages
 from django.shortcuts import redirect, get_object_or_404
-from snakeface.apps.main.models import Workflow
+from snakeface.apps.main.models import Workflow, WorkflowRun, WorkflowStatus
 from snakeface.apps.users.models import User
-from snakeface.apps.main.utils import CommandRunner, ThreadRunner
+from snakeface.apps.main.utils import SupervisedRunner, ThreadRunner
+from snakeface.apps.main import supervisor
+from snakeface.apps.main.cancel import (
+    CANCEL_CHECK_SECONDS,
+    cancel_requested,
+    register_runner,
+    unregister_runner,
+)
+from snakeface.apps.main.scheduler import run_queue
+from snakeface.apps.main.membership import is_member
+from snakeface.apps.main.archive import archive_runs
+from snakeface.apps.main.events import workflow_events
+from snakeface.apps.main.telemetry import sampler
+from django.db.models import Max
+from django.utils import timezone
+from django_q.tasks import async_task
 
-import re
+import datetime
+import heapq
+import itertools
+import threading
 
 # Notebook run workflow functions
 
@@ -23,133 +41,477 @@ def run_workflow(request, wid, uid):
     running_notebook = cfg.NOTEBOOK or cfg.NOTEBOOK_ONLY
 
     # Ensure the user has permission to run the workflow
-    if user not in workflow.members:
+    if not is_member(workflow, user):
         messages.info(request, "You are not allowed to run this workflow.")
 
     # The workflow cannot already be running
-    elif workflow.status == "RUNNING":
-        messages.info(request, "This workflow is already running.")
-
-    elif run_is_allowed(request) and running_notebook:
-        workflow.reset()
-        t = ThreadRunner(target=doRun, args=[workflow.id, user.id])
-        t.setDaemon(True)
-        t.set_workflow(workflow)
-        t.start()
-        workflow.thread = t.thread_id
-        workflow.save()
-        messages.success(request, "Workflow %s has started running." % workflow.id)
+    elif workflow.status in ["RUNNING", "QUEUED"]:
+        messages.info(request, "This workflow is already running or queued.")
+
+    elif running_notebook:
+
+        # Runs over the user or global limits are queued, and started later
+        run = run_queue.submit(workflow, user)
+        if run.status == "RUNNING":
+            messages.success(request, "Workflow %s has started running." % workflow.id)
+        else:
+            messages.info(
+                request,
+                "Workflow %s is queued, and will start when a run slot is free."
+                % workflow.id,
+            )
     else:
         messages.info(request, "Snakeface currently only supports notebook runs.")
+        return redirect("main:view_workflow", wid=workflow.id)
+
+    # Old runs are cleaned up (and archived) in the background
+    clean_runs_async(workflow)
     return redirect("main:view_workflow", wid=workflow.id)
 
 
-# Permissions
+def start_run(run):
+    """Start a workflow run with the configured run backend. For the
+    cluster backend, the web server only enqueues the run, and it is done by
+    a separate django_q worker process.
+    """
+    if cfg.RUN_BACKEND == "cluster":
+        async_task(
+            "snakeface.apps.main.tasks.doRun",
+            run.id,
+            task_name="workflow-%s-run-%s" % (run.workflow_id, run.id),
+        )
+        return
+
+    t = ThreadRunner(target=doRun, args=[run.id])
+    t.setDaemon(True)
+    t.set_workflow(run.workflow)
+    t.start()
+    WorkflowRun.objects.filter(pk=run.id).update(thread=t.thread_id)
+
+
+# Run history
 
 
-def run_is_allowed(request):
-    """Given a request, check that the run is allowed meaning:
-    1. If running a notebook, we aren't over quota for jobs
-    2. If not running a notebook, we aren't over user or global limits
+def purge_runs(wid, keep=None, chunk_size=1000):
+    """Delete the oldest runs of a workflow past RUN_HISTORY_LIMIT. Statuses
+    are deleted in chunks first, so a run with many statuses doesn't hold
+    one long delete (and lock) on the table.
     """
-    running_notebook = cfg.NOTEBOOK or cfg.NOTEBOOK_ONLY
-    running_jobs = Workflow.objects.filter(status="RUNNING").count()
-    allowed = True
-    if (
-        running_notebook
-        and cfg.MAXIMUM_NOTEBOOK_JOBS
-        and running_jobs >= cfg.MAXIMUM_NOTEBOOK_JOBS
-    ):
-        messages.info(
-            request,
-            "You already have the maximum %s jobs running." % cfg.MAXIMUM_NOTEBOOK_JOBS,
-        )
-        allowed = False
-
-    elif (
-        not running_notebook
-        and cfg.USER_WORKFLOW_RUNS_LIMIT
-        >= Workflow.objects.filter(user=request.user, status="RUNNING").count()
-    ):
-        messages.info(
-            request,
-            "You are at your workflow active runs limit. Finish some and try again later.",
-        )
-        allowed = False
+    keep = cfg.RUN_HISTORY_LIMIT if keep is None else keep
+    if not keep:
+        return 0
+    runs = WorkflowRun.objects.filter(workflow=wid).exclude(
+        status__in=["RUNNING", "QUEUED"]
+    )
+    current = Workflow.objects.filter(pk=wid).values_list("current_run", flat=True)
+    old = list(runs.exclude(pk__in=current).values_list("id", flat=True)[keep:])
+    for rid in old:
+        statuses = WorkflowStatus.objects.filter(run=rid)
+        while True:
+            ids = list(statuses.values_list("id", flat=True)[:chunk_size])
+            if not ids:
+                break
+            WorkflowStatus.objects.filter(id__in=ids).delete()
+
+        # Deleted one at a time so the post_delete signal removes logs
+        for run in WorkflowRun.objects.filter(pk=rid):
+            run.delete()
+    return len(old)
+
+
+def clean_runs(wid):
+    """Delete runs past RUN_HISTORY_LIMIT, and then archive the statuses of
+    the runs that are kept (STATUS_ARCHIVE_DAYS), one after the other so
+    a run isn't archived while it's deleted.
+    """
+    purge_runs(wid)
+    archive_runs(wid)
 
-    elif not running_notebook and cfg.USER_WORKFLOW_GLOBAL_RUNS_LIMIT >= running_jobs:
-        messages.info(
-            request,
-            "The server is at the global limit of workflow runs. Try again later.",
-        )
-        allowed = False
 
-    return allowed
+def clean_runs_async(workflow):
+    """Run clean_runs outside of the request, with the run backend"""
+    if not cfg.RUN_HISTORY_LIMIT and cfg.STATUS_ARCHIVE_DAYS is None:
+        return
+    if cfg.RUN_BACKEND == "cluster":
+        async_task("snakeface.apps.main.tasks.clean_runs", workflow.id)
+        return
+    t = threading.Thread(target=clean_runs, args=[workflow.id], daemon=True)
+    t.start()
 
 
 # Statuses
 
 
-def serialize_workflow_statuses(workflow):
+# Snakemake log levels, to filter the status table by
+STATUS_LEVEL_NAMES = [
+    "info",
+    "warning",
+    "error",
+    "debug",
+    "dag_debug",
+    "job_info",
+    "job_finished",
+    "job_error",
+    "shellcmd",
+    "progress",
+    "rule_info",
+    "run_info",
+]
+
+# Columns of the status table (see get_status_table) and their fields
+STATUS_COLUMNS = {1: "id", 2: "level", 3: "job", 4: "text"}
+
+# Fields of a status that are loaded to serialize it (with its workflow and
+# run ids, which the queryset checks), the others aren't
+STATUS_FIELDS = [
+    "id",
+    "workflow",
+    "run",
+    "msg",
+    "level",
+    "job",
+    "rule",
+    "timestamp",
+    "text",
+    "level_class",
+    "html",
+]
+
+
+def serialize_status(status, order):
+    """Serialize one status for the status table. How it's shown (the level
+    class, and the message formatted as code for a traceback) is stored
+    when the status is created, so this only projects columns.
+    """
+    entry = status.message
+    entry.update(
+        {
+            "id": status.id,
+            "order": order,
+            "job": status.job if status.job is not None else entry.get("job", ""),
+            "msg": status.html or status.text or "",
+            "level": status.level or "info",
+            "level_class": status.level_class or "secondary",
+        }
+    )
+    return entry
+
+
+def serialize_workflow_statuses(workflow, since=None):
     """A shared helper function to serialize a list of workflow statuses into
-    json.
+    json, optionally only the statuses after the status id since (with the
+    order they have in the run).
     """
-    levels = {
-        "debug": "primary",
-        "dag_debug": "primary",
-        "info": "info",
-        "warning": "warning",
-        "error": "danger",
+    statuses = workflow.iter_statuses(since, STATUS_FIELDS)
+    first = next(statuses, None)
+    if not first:
+        return []
+    start = workflow.count_statuses(since) if since else 0
+    return [
+        serialize_status(status, i)
+        for i, status in enumerate(itertools.chain([first], statuses), start)
+    ]
+
+
+def get_status_table(workflow, params):
+    """Return a page of statuses for the status table, with DataTables server
+    side processing parameters (draw, start, length, order, search, and
+    column searches for the level and job). The current run's statuses are
+    filtered, ordered and paged in the database. Statuses in a run archive
+    are filtered while they are read, and only the rows up to the end of
+    the page are kept to sort. The order of a status is its id.
+    """
+    start = max(0, int(params.get("start", 0)))
+    length = int(params.get("length", 50))
+    length = cfg.MAXIMUM_STATUS_PAGE if length < 0 else length
+    length = min(length, cfg.MAXIMUM_STATUS_PAGE)
+    column = STATUS_COLUMNS.get(int(params.get("order[0][column]", 1)), "id")
+    reverse = params.get("order[0][dir]") == "desc"
+    search = params.get("search[value]", "").strip()
+    level = params.get("columns[2][search][value]", "").strip()
+    job = params.get("columns[3][search][value]", "").strip()
+    job = int(job) if job else None
+    run = workflow.current_run
+
+    # Statuses in the database, with the (run, level) and (run, job) indexes
+    if not run or not run.archived_id:
+        statuses = workflow.get_statuses().only(*STATUS_FIELDS)
+        total = statuses.count()
+        if level:
+            statuses = statuses.filter(level=level)
+        if job is not None:
+            statuses = statuses.filter(job=job)
+        if search:
+            statuses = statuses.filter(text__icontains=search)
+        filtered = statuses.count() if level or job is not None or search else total
+        ordering = ["-" + column, "-id"] if reverse else [column, "id"]
+        page = list(statuses.order_by(*ordering)[start : start + length])
+        last_id = workflow.get_statuses().aggregate(last_id=Max("id"))["last_id"]
+        return get_status_page(params, workflow, page, total, filtered, last_id)
+
+    # An archived run is filtered as it's read, keeping only the first rows
+    counts = {"total": 0, "filtered": 0, "last_id": 0}
+
+    def matching():
+        for status in run.iter_statuses(fields=STATUS_FIELDS):
+            counts["total"] += 1
+            counts["last_id"] = status.id
+            if level and status.level != level:
+                continue
+            if job is not None and status.job != job:
+                continue
+            if search and search.lower() not in (status.text or "").lower():
+                continue
+            counts["filtered"] += 1
+            yield status
+
+    # Missing values sort first, and the id breaks ties
+    def key(status):
+        value = getattr(status, column)
+        return (value is not None, value, status.id)
+
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    page = select(start + length, matching(), key=key)[start:]
+    return get_status_page(
+        params, workflow, page, counts["total"], counts["filtered"], counts["last_id"]
+    )
+
+
+def get_status_page(params, workflow, page, total, filtered, last_id):
+    """The DataTables response for a page of the status table, with the last
+    status id and run for updates (see get_status_update).
+    """
+    return {
+        "draw": int(params.get("draw", 0)),
+        "recordsTotal": total,
+        "recordsFiltered": filtered,
+        "data": [serialize_status(status, status.id) for status in page],
+        "last_id": last_id or 0,
+        "run": workflow.current_run_id,
     }
-    data = []
-    for i, status in enumerate(workflow.workflowstatus_set.all()):
-        entry = status.msg
-        msg = entry.get("msg", "")
-        level = levels.get(entry.get("level"), "secondary")
-        badge = "<span class='badge badge-%s'>%s</span>" % (
-            level,
-            entry.get("level", "info"),
-        )
 
-        # If it's a traceback, format as code
-        if msg and re.search("traceback|exception", msg, re.IGNORECASE):
-            msg = "<code>%s</code>" % msg.replace("\n", "<br>")
-
-        entry.update(
-            {
-                "order": i,
-                "job": entry.get("job", ""),
-                "msg": msg,
-                "level": badge,
-            }
-        )
-        data.append(entry)
-    return data
 
+def get_status_update(workflow, since=None, run=None):
+    """Statuses for a client that has the statuses of a run up to the status
+    id since. If the client has none, or the current run has changed, all
+    statuses are returned, and reset is True. Statuses of a workflow get
+    their ids in the order they commit (see WorkflowStatus.add_batch), so
+    none can show up before since later. The client should keep last_id
+    and run for the next update.
+    """
+    current = workflow.current_run_id
+    reset = since is None or str(run or "") != str(current or "")
+    if reset:
+        since = 0
+    data = serialize_workflow_statuses(workflow, since=since)
+    return {
+        "data": data,
+        "last_id": data[-1]["id"] if data else since,
+        "run": current,
+        "reset": reset,
+    }
+
+
+def watch_run(run):
+    """Return a cancel function for the runner of a run (it's called every
+    CANCEL_CHECK_SECONDS), which also sends an event for the workflow when
+    the run logs have new output or error. Only the logs are checked, not
+    the database.
+    """
+    logs = [run.get_log("stdout"), run.get_log("stderr")]
+    last = {}
 
-def doRun(wid, uid):
+    def check(run):
+        positions = [log.position() for log in logs]
+        if positions != last.get("positions"):
+            last["positions"] = positions
+            workflow_events.send(run.workflow_id)
+        return cancel_requested(run)
+
+    return check
+
+
+def doRun(rid):
     """The task to run a workflow"""
-    workflow = Workflow.objects.get(pk=wid)
-    user = User.objects.get(pk=uid)
+    run = WorkflowRun.objects.select_related("workflow", "user").get(pk=rid)
+
+    # The supervisor streams output to the run logs, and outlives a restart
+    runner = SupervisedRunner(run.logs_dir)
+    run.status = "RUNNING"
+    run.start_date = timezone.now()
+
+    # Only these fields, the run is also updated elsewhere (e.g., pid, last_seq)
+    run.save(update_fields=["status", "start_date"])
+    workflow_events.send(run.workflow_id)
 
-    runner = CommandRunner()
-    workflow.status = "RUNNING"
-    workflow.save()
+    # Held while we wait on the run, so a restarted server leaves it alone
+    lock = supervisor.lock_wait(run.logs_dir)
 
-    # Define the function to determine cancelling the run
-    def cancel_workflow(wid):
-        workflow = Workflow.objects.get(pk=wid)
-        return workflow.status == "CANCELLED"
+    # Cancel in this process wakes the runner, otherwise a cancel file is used
+    register_runner(run, runner)
+    env = {"WMS_MONITOR_TOKEN": run.user.token} if run.user else {}
+
+    def started(pid):
+        """Record where the run is, so it can be found after a restart"""
+        WorkflowRun.objects.filter(pk=run.id).update(
+            pid=pid, host=supervisor.get_hostname()
+        )
+        sampler.register(pid, run.telemetry_file)
 
     # Run the command, update when finished
-    runner.run_command(
-        workflow.command.split(" "),
-        env={"WMS_MONITOR_TOKEN": user.token},
-        cancel_func=cancel_workflow,
-        cancel_func_kwargs={"wid": wid},
+    try:
+        runner.run_command(
+            run.command.split(" "),
+            env=env,
+            cancel_func=watch_run(run),
+            cancel_func_kwargs={"run": run},
+            cancel_interval=CANCEL_CHECK_SECONDS,
+            start_func=started,
+        )
+    finally:
+        unregister_runner(run)
+    try:
+        finish_run(run, runner)
+    finally:
+        if lock:
+            lock.close()
+
+
+def finish_run(run, runner):
+    """Save the result of a run from its runner, and start the next one"""
+    run.telemetry = sampler.unregister(runner.pid)
+
+    # Only the tail is saved to the run, the full logs stay on disk
+    run.error = "<br>".join(run.get_log("stderr").tail())
+    run.output = "<br>".join(run.get_log("stdout").tail())
+    run.status = "CANCELLED" if runner.cancelled else "NOTRUNNING"
+    run.end_date = timezone.now()
+    run.retval = runner.retval
+    run.cpu_time = runner.cpu_time
+    run.max_rss = runner.max_rss
+    run.wall_time = runner.wall_time
+    run.save(
+        update_fields=[
+            "telemetry",
+            "error",
+            "output",
+            "status",
+            "end_date",
+            "retval",
+            "cpu_time",
+            "max_rss",
+            "wall_time",
+        ]
+    )
+    workflow_events.send(run.workflow_id)
+
+    # Free the run slot, and start the next queued run
+    run_queue.finished(run.id)
+
+
+# Restarts
+
+# A run without a pid that started this recently may still be starting
+RUN_START_SECONDS = 60
+
+
+def reattach_run(run, lock):
+    """Wait for a run that was started before a restart, and finish it. The
+    wait lock of the run is held until it's finished.
+    """
+    runner = SupervisedRunner(run.logs_dir)
+    register_runner(run, runner)
+    start = run.start_date.timestamp() if run.start_date else None
+    sampler.register(run.pid, run.telemetry_file, start=start)
+    try:
+        runner.attach(
+            run.pid,
+            start=start,
+            cancel_func=watch_run(run),
+            cancel_func_kwargs={"run": run},
+            cancel_interval=CANCEL_CHECK_SECONDS,
+        )
+    finally:
+        unregister_runner(run)
+    try:
+        finish_run(run, runner)
+    finally:
+        lock.close()
+
+
+def reconcile_runs():
+    """Called when the server starts, to find runs that were RUNNING when it
+    stopped. A run whose supervisor is still alive (and orphaned) is attached
+    to again, and one that ended while we were down is finished with the exit
+    status that the supervisor wrote. A run that never got to start is
+    queued again. Runs on other hosts are left alone.
+
+    Every server process calls this, so a run is only attached to or
+    finished by the process that takes its wait lock (see doRun), and only
+    queued again by the process whose update changes its status. The lock
+    is a file lock, since SQLite can't lock rows (select_for_update).
+    """
+    host = supervisor.get_hostname()
+    runs = WorkflowRun.objects.filter(status="RUNNING").select_related(
+        "workflow", "user"
     )
-    workflow.error = "<br>".join(runner.error)
-    workflow.output = "<br>".join(runner.output)
-    workflow.status = "NOTRUNNING"
-    workflow.retval = runner.retval
-    workflow.save()
+    started_before = timezone.now() - datetime.timedelta(seconds=RUN_START_SECONDS)
+    for run in runs:
+        if run.host and run.host != host:
+            continue
+
+        # Not started yet, a cluster task (or a worker) might still start it
+        if not run.pid:
+            if cfg.RUN_BACKEND == "cluster":
+                continue
+            if run.start_date and run.start_date > started_before:
+                continue
+            queued = WorkflowRun.objects.filter(
+                pk=run.id, status="RUNNING", pid=None
+            ).update(status="QUEUED")
+            if queued:
+                print("Queueing %s again, it did not start" % run)
+            continue
+
+        # Another process is waiting on the run (or started it)
+        lock = supervisor.lock_wait(run.logs_dir)
+        if not lock:
+            continue
+
+        # And it may have finished the run before we took the lock
+        if not WorkflowRun.objects.filter(pk=run.id, status="RUNNING").exists():
+            lock.close()
+            continue
+
+        info = supervisor.read_info(run.logs_dir) or {}
+        started = supervisor.get_process_start(run.pid)
+        alive = (
+            started is not None
+            and info.get("pid") == run.pid
+            and abs(started - info.get("start", 0)) < 5
+        )
+
+        # The runner that started it is still waiting on it (e.g., a worker)
+        parent = supervisor.get_parent(run.pid)
+        if alive and parent not in [None, 1] and parent == info.get("parent"):
+            lock.close()
+            continue
+
+        if alive:
+            print("Attaching to %s, pid %s" % (run, run.pid))
+            t = threading.Thread(target=reattach_run, args=[run, lock], daemon=True)
+            t.start()
+            continue
+
+        print("Finishing %s, it ended while the server was down" % run)
+        runner = SupervisedRunner(run.logs_dir)
+        runner.cancelled = cancel_requested(run)
+        runner.finish(None)
+        try:
+            finish_run(run, runner)
+        finally:
+            lock.close()
+
+    # Start runs that were queued, or queued again above
+    run_queue.sync(force=True)
+    run_queue.dispatch()
@@ -0,0 +1,210 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+from snakeface.settings import cfg
+
+import json
+import os
+import threading
+import time
+
+# Each sample is [seconds since start, cpu %, rss KB, open fds, read bytes, write bytes]
+SAMPLE_FIELDS = ["time", "cpu", "rss", "fds", "read_bytes", "write_bytes"]
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE_KB = (os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096) // 1024
+
+
+def read_proc_stat(pid):
+    """Return the fields of /proc/<pid>/stat after the command name, which
+    can itself contain spaces and parentheses.
+    """
+    with open("/proc/%s/stat" % pid, "r") as fd:
+        content = fd.read()
+    return content[content.rindex(")") + 2 :].split(" ")
+
+
+def read_proc_io(pid):
+    """Return read and write bytes for a process, or zeros if not readable"""
+    counts = {}
+    try:
+        with open("/proc/%s/io" % pid, "r") as fd:
+            for line in fd:
+                key, value = line.split(":", 1)
+                counts[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counts.get("read_bytes", 0), counts.get("write_bytes", 0)
+
+
+def count_fds(pid):
+    try:
+        return len(os.listdir("/proc/%s/fd" % pid))
+    except OSError:
+        return 0
+
+
+def get_sessions(sessions):
+    """Walk /proc once, and return a lookup of session id to the pids in it,
+    for the sessions that we are interested in.
+    """
+    found = {sid: [] for sid in sessions}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            sid = int(read_proc_stat(pid)[3])
+        except (OSError, IndexError, ValueError):
+            continue
+        if sid in found:
+            found[sid].append(int(pid))
+    return found
+
+
+def downsample(samples, maximum):
+    """Reduce a list of samples to at most maximum by taking every nth"""
+    if not maximum or len(samples) <= maximum:
+        return samples
+    step = -(-len(samples) // maximum)
+    return samples[::step]
+
+
+class TelemetrySampler(object):
+    """A background sampler of resource usage for running workflows. Each run
+    is started in its own session (see CommandRunner) so the process tree is
+    every process in that session. Every TELEMETRY_INTERVAL seconds a single
+    pass over /proc collects cpu %, rss, open file descriptors and io for each
+    registered run, and appends a sample to the run's telemetry file. Only
+    the previous sample is kept in memory, and at most
+    TELEMETRY_MAX_PROCESSES are looked at per run, so overhead is bounded by
+    the interval and host size, not the length of a run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.thread = None
+        self._wakeup = threading.Event()
+
+    def __str__(self):
+        return "[telemetry-sampler:%s runs]" % len(self.runs)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def enabled(self):
+        return bool(cfg.TELEMETRY_INTERVAL) and os.path.exists("/proc")
+
+    def register(self, pid, filename, start=None):
+        """Start sampling the process tree (session) of a run, writing samples
+        to filename. The pid must be a session leader. The start time of the
+        run can be provided, e.g., when sampling a run again after a restart.
+        """
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with self.lock:
+            self.runs[pid] = {
+                "filename": filename,
+                "start": start or time.time(),
+                "last": None,
+            }
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def unregister(self, pid):
+        """Stop sampling a run, and return its (downsampled) time series"""
+        with self.lock:
+            run = self.runs.pop(pid, None)
+            if not self.runs:
+                self._wakeup.set()
+        if run:
+            return load_samples(run["filename"])
+
+    def run(self):
+        """Sample until there are no runs left to sample"""
+        while True:
+            self._wakeup.wait(timeout=cfg.TELEMETRY_INTERVAL)
+            self._wakeup.clear()
+            with self.lock:
+                runs = dict(self.runs)
+                if not runs:
+                    self.thread = None
+                    break
+            sessions = get_sessions(runs)
+            for sid, run in runs.items():
+                self.sample(run, sessions[sid][: cfg.TELEMETRY_MAX_PROCESSES])
+
+    def sample(self, run, pids):
+        """Take one sample for a run, given the pids in its process tree"""
+        now = time.time()
+        ticks = 0
+        rss = 0
+        fds = 0
+        read_bytes = 0
+        write_bytes = 0
+        for pid in pids:
+            try:
+                fields = read_proc_stat(pid)
+            except OSError:
+                continue
+
+            # utime, stime, cutime, cstime (waited for children) and rss
+            ticks += sum(int(x) for x in fields[11:15])
+            rss += int(fields[21]) * PAGE_SIZE_KB
+            fds += count_fds(pid)
+            reads, writes = read_proc_io(pid)
+            read_bytes += reads
+            write_bytes += writes
+
+        # Cpu is the change in ticks since the last sample (processes exit)
+        cpu = 0
+        last = run["last"]
+        if last:
+            elapsed = now - last[0]
+            if elapsed > 0:
+                cpu = max(0, ticks - last[1]) / CLOCK_TICKS / elapsed * 100
+        run["last"] = (now, ticks)
+
+        sample = [
+            round(now - run["start"], 1),
+            round(cpu, 1),
+            rss,
+            fds,
+            read_bytes,
+            write_bytes,
+        ]
+        try:
+            with open(run["filename"], "a") as fd:
+                fd.write(json.dumps(sample) + "\n")
+        except OSError:
+            pass
+
+
+def load_samples(filename, maximum=None):
+    """Load the samples for a run, downsampled to TELEMETRY_MAX_SAMPLES.
+    Every other sample is dropped while reading whenever we have twice the
+    maximum, so memory stays bounded for a long run.
+    """
+    maximum = maximum or cfg.TELEMETRY_MAX_SAMPLES
+    samples = []
+    step = 1
+    if filename and os.path.exists(filename):
+        with open(filename, "r") as fd:
+            for i, line in enumerate(fd):
+                if i % step != 0:
+                    continue
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:
+                    continue
+                if len(samples) >= 2 * maximum:
+                    samples = samples[::2]
+                    step *= 2
+    return downsample(samples, maximum)
+
+
+sampler = TelemetrySampler()
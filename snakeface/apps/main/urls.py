@@ -17,6 +17,16 @@ urlpatterns = [
         views.workflow_statuses,
         name="workflow_statuses",
     ),
+    path(
+        "workflows/<int:wid>/statuses/table/",
+        views.workflow_statuses_table,
+        name="workflow_statuses_table",
+    ),
+    path(
+        "workflows/<int:wid>/telemetry/",
+        views.workflow_telemetry,
+        name="workflow_telemetry",
+    ),
     path("workflows/<int:wid>/edit/", views.edit_workflow, name="edit_workflow"),
     path(
         "workflows/<int:wid>/report/",
@@ -3,8 +3,13 @@ __copyright__ = "Copyright 2020-2021, Vanessa Sochat"
 __license__ = "MPL 2.0"
 
 from snakeface.settings import cfg
+from snakeface.apps.main import supervisor
 import subprocess
 import threading
+import select
+import signal
+import sys
+import time
 
 import tempfile
 import os
@@ -93,23 +98,47 @@ class ThreadRunner(threading.Thread):
 
 class CommandRunner(object):
     """Wrapper to use subprocess to run a command. This is based off of pypi
-    vendor distlib SubprocesMixin.
+    vendor distlib SubprocesMixin. Waiting on the process is event driven:
+    a waiter thread blocks on the child, and the calling thread sleeps on an
+    event until the process finishes or a cancel is requested. The command
+    is started in its own session, so that cancelling terminates the whole
+    process tree (e.g., jobs that snakemake started) and not just the top.
     """
 
-    def __init__(self):
+    def __init__(self, grace_period=None):
+        self.grace_period = grace_period
+        if self.grace_period is None:
+            self.grace_period = cfg.CANCEL_GRACE_SECONDS
         self.reset()
 
     def reset(self):
         self.error = []
         self.output = []
         self.retval = None
+        self.cancelled = False
+        self.cpu_time = None
+        self.max_rss = None
+        self.wall_time = None
+        self.pid = None
+        self._wakeup = threading.Event()
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Request that the running command is terminated. This wakes up
+        run_command right away instead of waiting for the next cancel check.
+        """
+        self.cancelled = True
+        self._wakeup.set()
 
     def reader(self, stream, context):
-        """Get output and error lines and save to command runner."""
+        """Get output and error lines and save to command runner, or stream
+        them to a log (e.g., a RunLog) if one is provided for the context.
+        """
         # Make sure we save to the correct field
         lines = self.error
         if context == "stdout":
             lines = self.output
+        lines = self.logs.get(context, lines)
 
         while True:
             s = stream.readline()
@@ -118,10 +147,62 @@ class CommandRunner(object):
             lines.append(s.decode("utf-8"))
         stream.close()
 
+    def waiter(self, p):
+        """Block until the process exits, then wake up run_command. We reap
+        the process with wait4 to get resource usage, which includes the
+        children of the process that it waited for.
+        """
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+            p.returncode = get_returncode(status)
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+            self.max_rss = rusage.ru_maxrss
+        except ChildProcessError:
+            p.wait()
+        self.wall_time = time.time() - self._start
+        self._done.set()
+        self._wakeup.set()
+
+    def signal_group(self, p, signum):
+        """Send a signal to the process group of the command, if it exists"""
+        try:
+            os.killpg(p.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def terminate(self, p):
+        """Terminate the process tree of the command. The process group gets
+        SIGTERM, and after the grace period anything left gets SIGKILL.
+        """
+        self.signal_group(p, signal.SIGTERM)
+        if not self._done.wait(timeout=self.grace_period):
+            print("Process did not exit after %s seconds, killing" % self.grace_period)
+
+        # Also clean up children that outlived the main process
+        self.signal_group(p, signal.SIGKILL)
+        self._done.wait()
+
     def run_command(
-        self, cmd, env=None, cancel_func=None, cancel_func_kwargs=None, **kwargs
+        self,
+        cmd,
+        env=None,
+        cancel_func=None,
+        cancel_func_kwargs=None,
+        cancel_interval=1,
+        logs=None,
+        start_func=None,
+        start_func_kwargs=None,
+        **kwargs
     ):
+        """Run a command, capturing output and error. If a cancel_func is
+        provided, it is called every cancel_interval seconds while the
+        process is running, and the process is terminated if it returns True.
+        Logs (a lookup of stdout and/or stderr to an object with append) can
+        be provided to stream lines there instead of keeping them in memory.
+        If a start_func is provided, it is called with the pid once started.
+        """
         self.reset()
+        self.logs = logs or {}
         cancel_func_kwargs = cancel_func_kwargs or {}
 
         # If we need to update the environment
@@ -131,38 +212,185 @@ class CommandRunner(object):
         if env:
             envars.update(env)
 
+        self._start = time.time()
         p = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=envars, **kwargs
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=envars,
+            start_new_session=True,
+            **kwargs
         )
 
-        # Create threads for error and output
+        self.pid = p.pid
+        if start_func:
+            start_func(p.pid, **(start_func_kwargs or {}))
+
+        # Create threads for error and output, and one to wait on the process
         t1 = threading.Thread(target=self.reader, args=(p.stdout, "stdout"))
         t1.start()
         t2 = threading.Thread(target=self.reader, args=(p.stderr, "stderr"))
         t2.start()
+        t3 = threading.Thread(target=self.waiter, args=(p,), daemon=True)
+        t3.start()
+
+        self.wait(p, cancel_func, cancel_func_kwargs, cancel_interval)
+        t3.join()
+        t1.join()
+        t2.join()
+        self.retval = p.returncode
+        return self.output
 
-        # Continue running unless cancel function is called
-        counter = 0
+    def wait(self, p, cancel_func=None, cancel_func_kwargs=None, cancel_interval=1):
+        """Sleep until the process finishes, or wake up to check for cancel,
+        and terminate the process tree if the run is cancelled.
+        """
+        cancel_func_kwargs = cancel_func_kwargs or {}
         while True:
+            finished = self._wakeup.wait(
+                timeout=cancel_interval if cancel_func else None
+            )
+            self._wakeup.clear()
 
-            # Check on process for finished or cancelled
-            if p.poll() != None:
+            if self._done.is_set():
                 print("Return value found, stopping.")
                 break
 
-            # Check the cancel function every 100 loops
-            elif (
-                counter % 10000 == 0
-                and cancel_func
-                and cancel_func(**cancel_func_kwargs)
-            ):
+            if not finished and cancel_func and cancel_func(**cancel_func_kwargs):
+                self.cancelled = True
+
+            if self.cancelled:
                 print("Process is terminated")
-                p.terminate()
+                self.terminate(p)
                 break
-            counter += 1
 
-        # p.wait()
-        t1.join()
-        t2.join()
-        self.retval = p.returncode
-        return self.output
+
+class SupervisedRunner(CommandRunner):
+    """Run a command under the supervisor (see supervisor.py), which is the
+    leader of its own session and survives a restart of the web server. The
+    supervisor writes output to the run logs and the exit status of the
+    command to status.json, so a new web server process can attach to a run
+    that is still going, or finish one that ended while it was down.
+    """
+
+    def __init__(self, root, grace_period=None):
+        self.root = root
+        super().__init__(grace_period)
+
+    def run_command(
+        self,
+        cmd,
+        env=None,
+        cancel_func=None,
+        cancel_func_kwargs=None,
+        cancel_interval=1,
+        start_func=None,
+        start_func_kwargs=None,
+        **kwargs
+    ):
+        """Start the command under the supervisor, and wait for it to finish"""
+        self.reset()
+        envars = os.environ.copy()
+        if env:
+            envars.update(env)
+
+        os.makedirs(self.root, exist_ok=True)
+        self._start = time.time()
+        with open(os.path.join(self.root, supervisor.SUPERVISOR_LOG), "ab") as log:
+            p = subprocess.Popen(
+                [sys.executable, supervisor.__file__, self.root, "--"] + cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=envars,
+                start_new_session=True,
+                **kwargs
+            )
+
+        self.pid = p.pid
+        if start_func:
+            start_func(p.pid, **(start_func_kwargs or {}))
+
+        t = threading.Thread(target=self.waiter, args=(p,), daemon=True)
+        t.start()
+        self.wait(p, cancel_func, cancel_func_kwargs, cancel_interval)
+        t.join()
+        self.finish(p.returncode)
+
+    def attach(
+        self,
+        pid,
+        start=None,
+        cancel_func=None,
+        cancel_func_kwargs=None,
+        cancel_interval=1,
+    ):
+        """Wait for a supervisor that was started by another process (e.g.,
+        before the web server restarted). It isn't our child, so we can't
+        wait4 it, and we wait for the pid to go away instead.
+        """
+        self.reset()
+        self._start = start or time.time()
+        self.pid = pid
+        p = AttachedProcess(pid)
+        t = threading.Thread(target=self.watcher, args=(p,), daemon=True)
+        t.start()
+        self.wait(p, cancel_func, cancel_func_kwargs, cancel_interval)
+        t.join()
+        self.finish(None)
+
+    def watcher(self, p):
+        """Block until a process that isn't our child exits. A pidfd wakes us
+        up right away where supported, otherwise we check every second.
+        """
+        try:
+            fd = os.pidfd_open(p.pid)
+        except (AttributeError, OSError):
+            fd = None
+        if fd is not None:
+            select.select([fd], [], [])
+            os.close(fd)
+        else:
+            while p.exists():
+                time.sleep(1)
+        self.wall_time = time.time() - self._start
+        self._done.set()
+        self._wakeup.set()
+
+    def finish(self, returncode):
+        """Use the exit status of the command written by the supervisor. If
+        the supervisor was killed, fall back to what we know from waiting.
+        """
+        status = supervisor.read_status(self.root) or {}
+        self.retval = status.get("retval", returncode)
+        for key in ["cpu_time", "max_rss", "wall_time"]:
+            if status.get(key) is not None:
+                setattr(self, key, status[key])
+
+
+class AttachedProcess(object):
+    """The part of a Popen needed to wait on and terminate a process that
+    isn't our child.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def exists(self):
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+
+def get_returncode(status):
+    """Convert a wait status into a return code, the same as subprocess does
+    (negative for a process ended by a signal)
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
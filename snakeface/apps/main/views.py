@@ -10,9 +10,18 @@ import os
 from ratelimit.decorators import ratelimit
 from snakeface.argparser import SnakefaceParser
 from snakeface.settings import cfg
-from snakeface.apps.main.models import Workflow
+from snakeface.apps.main.models import Workflow, WorkflowRun
 from snakeface.apps.main.forms import WorkflowForm
-from snakeface.apps.main.tasks import run_workflow, serialize_workflow_statuses
+from snakeface.apps.main.tasks import (
+    get_status_table,
+    get_status_update,
+    run_workflow,
+    STATUS_LEVEL_NAMES,
+)
+from snakeface.apps.main.cancel import request_cancel
+from snakeface.apps.main.membership import is_owner
+from snakeface.apps.main.scheduler import run_queue
+from snakeface.apps.main.telemetry import SAMPLE_FIELDS
 from snakeface.apps.users.decorators import login_is_required
 from snakeface.settings import (
     VIEW_RATE_LIMIT as rl_rate,
@@ -28,7 +37,9 @@ from snakeface.settings import (
 def index(request):
     workflows = None
     if request.user.is_authenticated:
-        workflows = Workflow.objects.filter(owners=request.user)
+        workflows = Workflow.objects.filter(owners=request.user).select_related(
+            "current_run"
+        )
     return render(
         request,
         "main/index.html",
@@ -45,7 +56,7 @@ def delete_workflow(request, wid):
     workflow = get_object_or_404(Workflow, pk=wid)
 
     # Ensure that the user is an owner
-    if request.user not in workflow.owners.all():
+    if not is_owner(workflow, request.user):
         return HttpResponseForbidden()
     workflow.delete()
     return redirect("main:dashboard")
@@ -57,13 +68,20 @@ def cancel_workflow(request, wid):
     workflow = get_object_or_404(Workflow, pk=wid)
 
     # Ensure that the user is an owner
-    if request.user not in workflow.owners.all():
+    if not is_owner(workflow, request.user):
         return HttpResponseForbidden()
-    workflow.status = "CANCELLED"
-    workflow.save()
-    messages.info(
-        request, "Your workflow has been cancelled, and will stop within 10 seconds."
-    )
+    run = workflow.current_run
+    if run:
+        # A queued run is just removed from the queue, unless it was claimed
+        # to start (see RunQueue.dispatch) since we loaded it
+        queued = WorkflowRun.objects.filter(pk=run.pk, status="QUEUED")
+        if queued.update(status="CANCELLED"):
+            run_queue.remove(run.id)
+        else:
+            request_cancel(run)
+            run.status = "CANCELLED"
+            run.save(update_fields=["status"])
+    messages.info(request, "Your workflow has been cancelled, and will stop shortly.")
     return redirect("main:view_workflow", wid=workflow.id)
 
 
@@ -74,7 +92,7 @@ def edit_workflow(request, wid):
     workflow = get_object_or_404(Workflow, pk=wid)
 
     # Ensure that the user is an owner
-    if request.user not in workflow.owners.all():
+    if not is_owner(workflow, request.user):
         return HttpResponseForbidden()
 
     # Give a warning if the snakefile doesn't exist
@@ -105,7 +123,7 @@ def edit_or_update_workflow(request, parser, workflow=None):
     if workflow:
         existed = True
         action = "update"
-        if request.user not in workflow.owners.all():
+        if not is_owner(workflow, request.user):
             return HttpResponseForbidden()
     else:
         workflow = Workflow()
@@ -181,9 +199,54 @@ def workflow_command(request):
 
 @login_is_required
 def workflow_statuses(request, wid):
-    """return serialized workflow statuses for the details view."""
+    """return serialized workflow statuses for the details view. With
+    ?since=<last_id>&run=<run> only newer statuses of the run are returned
+    (see get_status_update), with the new last_id.
+    """
+    workflow = get_object_or_404(Workflow.objects.select_related("current_run"), pk=wid)
+    since = request.GET.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return JsonResponse({"message": "since must be a status id."}, status=400)
+    return JsonResponse(get_status_update(workflow, since, request.GET.get("run")))
+
+
+@login_is_required
+def workflow_statuses_table(request, wid):
+    """return a page of workflow statuses for the status table, with server
+    side processing (ordering, paging and filters in the database).
+    """
+    workflow = get_object_or_404(Workflow.objects.select_related("current_run"), pk=wid)
+    try:
+        data = get_status_table(workflow, request.GET)
+    except ValueError:
+        return JsonResponse({"message": "Invalid table parameters."}, status=400)
+    return JsonResponse(data)
+
+
+@login_is_required
+def workflow_telemetry(request, wid):
+    """return resource usage samples of the workflow run for the details view."""
     workflow = get_object_or_404(Workflow, pk=wid)
-    return JsonResponse({"data": serialize_workflow_statuses(workflow)})
+    run = workflow.current_run
+    samples = run.get_telemetry() if run else None
+    return JsonResponse({"fields": SAMPLE_FIELDS, "samples": samples or []})
+
+
+def get_run_history(workflow, count=10):
+    """Return the most recent runs of a workflow, each with the change in
+    wall time from the run before it (to spot regressions).
+    """
+    runs = list(workflow.workflowrun_set.all()[: count + 1])
+    for run, previous in zip(runs, runs[1:] + [None]):
+        run.wall_time_change = None
+        if run.wall_time and previous and previous.wall_time:
+            run.wall_time_change = (
+                (run.wall_time - previous.wall_time) / previous.wall_time * 100
+            )
+    return runs[:count]
 
 
 @login_is_required
@@ -191,11 +254,16 @@ def workflow_statuses(request, wid):
 def view_workflow(request, wid):
 
     workflow = get_object_or_404(Workflow, pk=wid)
+    run = workflow.current_run
     return render(
         request,
         "workflows/detail.html",
         {
             "workflow": workflow,
+            "run": run,
+            "runs": get_run_history(workflow),
+            "queue": run_queue.get_position(run.id) if run else None,
+            "levels": STATUS_LEVEL_NAMES,
             "page_title": "%s: %s" % (workflow.name or "Workflow", workflow.id),
         },
     )
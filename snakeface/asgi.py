@@ -1,15 +1,33 @@
 import os
+import signal
 
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+from django.db.utils import DatabaseError
+from django.urls import re_path
 from snakeface.apps.main import routing
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "snakeface.settings")
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
+        "http": URLRouter(
+            routing.http_urlpatterns + [re_path(r"", get_asgi_application())]
+        ),
         "websocket": AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns)),
     }
 )
+
+# Buffered statuses are flushed at exit, and on SIGTERM (atexit doesn't run)
+from snakeface.apps.main.ingest import status_buffer  # noqa
+
+status_buffer.stop_on(signal.SIGTERM)
+
+# Attach to (or finish) runs that were going when the server last stopped
+from snakeface.apps.main.tasks import reconcile_runs  # noqa
+
+try:
+    reconcile_runs()
+except DatabaseError as e:
+    print("Cannot reconcile workflow runs: %s" % e)
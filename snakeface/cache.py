@@ -0,0 +1,70 @@
+__author__ = "Vanessa Sochat"
+__copyright__ = "Copyright 2020-2021, Vanessa Sochat"
+__license__ = "MPL 2.0"
+
+import collections
+import threading
+import time
+
+# Returned by get for a missing (or expired) key, since None can be cached
+MISSING = object()
+
+
+class TTLCache(object):
+    """A small, process local, thread safe cache. Entries expire after ttl
+    seconds, and when the cache is over size the least recently used entry
+    is dropped. Callers are expected to invalidate entries when the source
+    changes (e.g., from model signals), the ttl only bounds how stale an
+    entry can be if an invalidation is missed (e.g., another process).
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "[ttl-cache:%s/%s]" % (len(self.entries), self.size)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Return the value for a key, or MISSING"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_matching(self, func):
+        """Delete the entries where func(key, value) is True"""
+        with self.lock:
+            for key, (value, _) in list(self.entries.items()):
+                if func(key, value):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
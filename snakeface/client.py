@@ -9,6 +9,7 @@ from django.core.wsgi import get_wsgi_application
 from django.core import management
 from snakeface.version import __version__
 import argparse
+import subprocess
 import sys
 import os
 
@@ -142,6 +143,7 @@ def main():
         os.putenv("SNAKEFACE_WORKDIR", args.workdir)
 
     application = get_wsgi_application()
+    from snakeface.settings import cfg
 
     # customize django logging
     setup_logger(
@@ -155,15 +157,30 @@ def main():
     management.call_command("makemigrations", verbosity=args.verbosity)
     for app in ["users", "main", "base"]:
         management.call_command("makemigrations", app, verbosity=args.verbosity)
+
+    # Data migrations (e.g., to backfill new columns) are written after
+    from snakeface.apps.main.datamigrations import write_data_migrations
+
+    write_data_migrations()
     management.call_command("migrate", verbosity=args.verbosity)
 
-    # management.call_command("qcluster", verbosity=args.verbosity)
     management.call_command(
         "collectstatic", verbosity=args.verbosity, interactive=False
     )
-    management.call_command(
-        "runserver", args.port, verbosity=args.verbosity, noreload=not args.noreload
-    )
+
+    # With the cluster backend, runs are done by separate worker processes.
+    # The autoreloader runs main again in a child (RUN_MAIN), start only once
+    cluster = None
+    if cfg.RUN_BACKEND == "cluster" and os.environ.get("RUN_MAIN") != "true":
+        cluster = subprocess.Popen([sys.executable, "-m", "django", "qcluster"])
+    try:
+        management.call_command(
+            "runserver", args.port, verbosity=args.verbosity, noreload=not args.noreload
+        )
+    finally:
+        if cluster:
+            cluster.terminate()
+            cluster.wait()
     sys.exit(0)
 
 
@@ -12,6 +12,7 @@ def globals(request):
     return {
         "DOMAIN": settings.DOMAIN_NAME,
         "WORKFLOW_UPDATE_SECONDS": settings.cfg.WORKFLOW_UPDATE_SECONDS,
+        "LOG_TAIL_LINES": settings.cfg.LOG_TAIL_LINES,
         "NOTEBOOK": settings.cfg.NOTEBOOK,
         "TWITTER_USERNAME": settings.cfg.TWITTER_USERNAME,
         "GITHUB_REPOSITORY": settings.cfg.GITHUB_REPOSITORY,
@@ -110,6 +110,53 @@ if not hasattr(cfg, "NOTEBOOK"):
 if not hasattr(cfg, "WORKDIR") or not cfg.WORKDIR:
     cfg.WORKDIR = os.getcwd()
 
+# Workflow run logs are kept alongside the database by default
+if not getattr(cfg, "LOGS_DIRECTORY", None):
+    cfg.LOGS_DIRECTORY = os.path.join(BASE_DIR, "logs")
+cfg.LOG_SEGMENT_SIZE = int(cfg.LOG_SEGMENT_SIZE)
+cfg.LOG_TAIL_LINES = int(cfg.LOG_TAIL_LINES)
+
+# Workflow runs are done in a server thread, or by a django_q cluster
+if cfg.RUN_BACKEND not in ["thread", "cluster"]:
+    sys.exit("RUN_BACKEND must be one of thread or cluster.")
+if cfg.RUN_WORKERS:
+    cfg.RUN_WORKERS = int(cfg.RUN_WORKERS)
+if cfg.RUN_TIMEOUT:
+    cfg.RUN_TIMEOUT = int(cfg.RUN_TIMEOUT)
+cfg.CANCEL_GRACE_SECONDS = float(cfg.CANCEL_GRACE_SECONDS)
+cfg.QUEUE_SYNC_SECONDS = float(cfg.QUEUE_SYNC_SECONDS)
+if cfg.RUN_HISTORY_LIMIT:
+    cfg.RUN_HISTORY_LIMIT = int(cfg.RUN_HISTORY_LIMIT)
+if cfg.STATUS_ARCHIVE_DAYS is not None:
+    cfg.STATUS_ARCHIVE_DAYS = float(cfg.STATUS_ARCHIVE_DAYS)
+cfg.MAXIMUM_STATUS_BATCH = int(cfg.MAXIMUM_STATUS_BATCH)
+cfg.MAXIMUM_STATUS_PAGE = int(cfg.MAXIMUM_STATUS_PAGE)
+cfg.TOKEN_CACHE_SECONDS = float(cfg.TOKEN_CACHE_SECONDS)
+cfg.TOKEN_CACHE_SIZE = int(cfg.TOKEN_CACHE_SIZE)
+cfg.MEMBERSHIP_CACHE_SECONDS = float(cfg.MEMBERSHIP_CACHE_SECONDS)
+cfg.MEMBERSHIP_CACHE_SIZE = int(cfg.MEMBERSHIP_CACHE_SIZE)
+if cfg.MONITOR_ADDRESS_RATE:
+    cfg.MONITOR_ADDRESS_RATE = float(cfg.MONITOR_ADDRESS_RATE)
+    cfg.MONITOR_ADDRESS_BURST = float(cfg.MONITOR_ADDRESS_BURST)
+if cfg.MONITOR_TOKEN_RATE:
+    cfg.MONITOR_TOKEN_RATE = float(cfg.MONITOR_TOKEN_RATE)
+    cfg.MONITOR_TOKEN_BURST = float(cfg.MONITOR_TOKEN_BURST)
+if cfg.MONITOR_WORKFLOW_RATE:
+    cfg.MONITOR_WORKFLOW_RATE = float(cfg.MONITOR_WORKFLOW_RATE)
+    cfg.MONITOR_WORKFLOW_BURST = float(cfg.MONITOR_WORKFLOW_BURST)
+cfg.MONITOR_RATE_KEYS = int(cfg.MONITOR_RATE_KEYS)
+if isinstance(cfg.STATUS_BUFFER, str):
+    cfg.STATUS_BUFFER = cfg.STATUS_BUFFER.lower() in ["true", "yes", "1"]
+cfg.STATUS_BUFFER_SIZE = int(cfg.STATUS_BUFFER_SIZE)
+cfg.STATUS_FLUSH_MS = float(cfg.STATUS_FLUSH_MS)
+cfg.WORKFLOW_PUSH_MS = float(cfg.WORKFLOW_PUSH_MS)
+cfg.WORKFLOW_STREAM_FRAMES = int(cfg.WORKFLOW_STREAM_FRAMES)
+cfg.STATUS_FLUSH_COUNT = int(cfg.STATUS_FLUSH_COUNT)
+if cfg.TELEMETRY_INTERVAL:
+    cfg.TELEMETRY_INTERVAL = float(cfg.TELEMETRY_INTERVAL)
+cfg.TELEMETRY_MAX_SAMPLES = int(cfg.TELEMETRY_MAX_SAMPLES)
+cfg.TELEMETRY_MAX_PROCESSES = int(cfg.TELEMETRY_MAX_PROCESSES)
+
 # SECURITY WARNING: App Engine's security features ensure that it is safe to
 # have ALLOWED_HOSTS = ['*'] when the app is deployed. If you deploy a Django
 # app not on App Engine, make sure to set an appropriate host here.
@@ -164,10 +211,21 @@ if cfg.ENABLE_CACHE:
     CACHE_MIDDLEWARE_ALIAS = "default"
     CACHE_MIDDLEWARE_SECONDS = 86400  # one day
 
+# Record monitor requests to replay them later (replay_monitor)
+if cfg.MONITOR_RECORD_DIRECTORY:
+    MIDDLEWARE += ["snakeface.apps.api.recorder.MonitorRecorder"]
+
 
-# If we are using a notebook, use an in memory channel layer
-if cfg.NOTEBOOK:
-    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# Workflow updates are pushed through the channel layer, which is in memory
+# (for this process) unless there is a redis to share between processes
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+if cfg.CHANNEL_REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [cfg.CHANNEL_REDIS_URL]},
+        }
+    }
 
 
 ROOT_URLCONF = "snakeface.urls"
@@ -292,11 +350,16 @@ AUTH_PASSWORD_VALIDATORS = [
 # Django Q
 # workers defaults to multiprocessing CPU count, can be set if neede
 # This can be sped up running with another database
+# A run holds its task for as long as snakemake runs, so the broker must not
+# hand it to another worker (retry) before the run timeout, or ever retry it.
 
 Q_CLUSTER = {
     "name": "snakecluster",
-    "timeout": 90,
-    "retry": 120,
+    "workers": cfg.RUN_WORKERS,
+    "timeout": cfg.RUN_TIMEOUT,
+    "retry": (cfg.RUN_TIMEOUT or 60 * 60 * 24 * 365) + 60,
+    "max_attempts": 1,
+    "ack_failures": True,
     "queue_limit": 50,
     "bulk": 10,
     "orm": "default",
@@ -2,7 +2,7 @@ __author__ = "Vanessa Sochat"
 __copyright__ = "Copyright 2020-2021, Vanessa Sochat"
 __license__ = "MPL 2.0"
 
-__version__ = "0.0.18"
+__version__ = "0.0.19"
 AUTHOR = "Vanessa Sochat"
 AUTHOR_EMAIL = "vsochat@stanford.edu"
 NAME = "snakeface"
@@ -39,6 +39,8 @@ INSTALL_REQUIRES = (
 
 EMAIL_REQUIRES = (("sendgrid", {"min_version": "6.4.3"}),)
 
+REDIS_REQUIRES = (("channels-redis", {"min_version": "3.2.0"}),)
+
 TESTS_REQUIRES = (("pytest", {"min_version": "4.6.2"}),)
 
-ALL_REQUIRES = INSTALL_REQUIRES + EMAIL_REQUIRES
+ALL_REQUIRES = INSTALL_REQUIRES + EMAIL_REQUIRES + REDIS_REQUIRES